@@ -0,0 +1,106 @@
+import os
+from array import array
+from typing import Dict, Optional, Set
+
+import config
+import snapshot
+import stored
+from stored import db_context
+
+
+class BeatmapIndex:
+    """In-memory copy of `maps` (md5 -> id) and of the .osu folder listing."""
+
+    def __init__(self):
+        self._rows: Dict[str, int] = {}
+        self._ids = array('q')
+        self._osu_files: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, md5: str) -> bool:
+        return md5 in self._rows
+
+    def add(self, md5: str, map_id: int):
+        self._rows[md5] = len(self._ids)
+        self._ids.append(map_id)
+
+    def get_id(self, md5: str) -> Optional[int]:
+        row = self._rows.get(md5)
+        return None if row is None else self._ids[row]
+
+    def osu_file(self, md5: str) -> Optional[str]:
+        """Path of the map's .osu file, or None if the map or its file is unknown."""
+        map_id = self.get_id(md5)
+        if map_id is None or map_id not in self._osu_files:
+            return None
+        return config.osu_file_folder + f"{map_id}.osu"
+
+    async def load(self, target: bool = False):
+        """Read the source `maps` (or the snapshot's), or with target the target database's `maps`."""
+        self._rows.clear()
+        del self._ids[:]
+        if snapshot.current is not None and not target:
+            for md5, map_id in snapshot.current.maps():
+                self.add(md5, map_id)
+        else:
+            async with db_context(stored.target_pool if target else stored.source_pool) as (_, cur):
+                await cur.execute('select md5, id from maps')
+                async for row in cur:
+                    self.add(row['md5'], row['id'])
+        self._osu_files = set()
+        with os.scandir(config.osu_file_folder) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+                if ext == '.osu' and name.isdigit():
+                    self._osu_files.add(int(name))
+
+
+class MissingBeatmaps:
+    """Collects maps_lack entries, each md5 once, and writes them in bulk.
+
+    lack_type is 'entry' when the map is not in `maps`, 'file' when its .osu file is not in osu_file_folder."""
+
+    def __init__(self, flush_size: int):
+        self.flush_size = flush_size
+        self._lacks: Dict[str, str] = {}
+        self._pending: Dict[str, str] = {}
+        self._scores: Dict[str, int] = {}
+
+    def record(self, md5: str, lack_type: str, score_count: int):
+        if md5 not in self._lacks:
+            self._lacks[md5] = lack_type
+            self._pending[md5] = lack_type
+        self._scores[lack_type] = self._scores.get(lack_type, 0) + score_count
+
+    @property
+    def should_flush(self) -> bool:
+        return len(self._pending) >= self.flush_size
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        async with db_context(stored.target_pool) as (_, cur):
+            await cur.executemany('insert into maps_lack (md5, lack_type) values (%s, %s) '
+                                  'on duplicate key update md5=md5', list(pending.items()))
+
+    def summary(self) -> str:
+        maps = {}
+        for lack_type in self._lacks.values():
+            maps[lack_type] = maps.get(lack_type, 0) + 1
+        counts = ', '.join(f'{lack_type}: {maps[lack_type]} maps ({self._scores[lack_type]} scores)'
+                           for lack_type in sorted(maps))
+        return f'missing beatmaps: {counts or "none"}'
+
+
+index = BeatmapIndex()
+lacks: MissingBeatmaps = None
+
+
+async def load_index(lack_flush_size: int, target: bool = False):
+    global lacks
+    await index.load(target)
+    if lacks is None:
+        lacks = MissingBeatmaps(lack_flush_size)
@@ -0,0 +1,285 @@
+"""Offline throughput benchmark for the migration phases.
+
+Generates synthetic gulag score tables, maps, .osu files and replays in a temp dir, points `stored` at SQLite
+stand-ins (fakedb.py) and runs run_scores_update, run_stats_update and run_rank_update against them.
+Prints one JSON document with scores/sec, DB round trips per score and peak memory per phase:
+
+    python benchmark.py --scores 20000 --maps 200 --users 500 --output bench.json
+"""
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+SOURCE_SCHEMA = (
+    'create table maps (id integer primary key, md5 text not null unique, status integer not null, '
+    'total_length integer not null)',
+    *(f'create table {table_name} (id integer primary key, map_md5 text not null, score integer not null, '
+      'pp real not null, acc real not null, max_combo integer not null, mods integer not null, '
+      'n300 integer not null, n100 integer not null, n50 integer not null, nmiss integer not null, '
+      'ngeki integer not null, nkatu integer not null, grade text not null, status integer not null, '
+      'mode integer not null, play_time integer not null, time_elapsed integer not null, '
+      'client_flags integer not null, userid integer not null, perfect integer not null, '
+      'online_checksum text not null)'
+      for table_name in ('scores_vn', 'scores_rx', 'scores_ap')),
+)
+
+TARGET_SCHEMA = (
+    'create table maps (id integer primary key, md5 text not null unique, status integer not null, '
+    'total_length integer not null)',
+    'create table users (id integer primary key)',
+    'create table stats (id integer not null, mode integer not null, total_hits integer not null default 0, '
+    'plays integer not null default 0, playtime integer not null default 0, pp integer not null default 0, '
+    'acc real not null default 0, primary key (id, mode))',
+    'create table scores (id integer primary key, map_md5 text not null, score integer not null, '
+    'pp real not null, acc real not null, max_combo integer not null, mods integer not null, '
+    'n300 integer not null, n100 integer not null, n50 integer not null, nmiss integer not null, '
+    'ngeki integer not null, nkatu integer not null, grade text not null, status integer not null, '
+    'mode integer not null, play_time integer not null, time_elapsed integer not null, '
+    'client_flags integer not null, userid integer not null, perfect integer not null, '
+    'online_checksum text not null)',
+    'create index scores_userid_mode on scores (userid, mode)',
+    'create table maps_lack (md5 text primary key, lack_type text not null)',
+)
+
+TABLE_MODS = {
+    'scores_vn': (0, 8, 16, 24, 64, 72, 88, 576, 2, 256, 1024, 1 | 8, 1 << 29),
+    'scores_rx': (128, 128 | 8, 128 | 64, 128 | 16, 128 | 72),
+    'scores_ap': (8192, 8192 | 8, 8192 | 64),
+}
+MODES = [0, 1, 2, 3, 4, 5, 6, 8]
+
+
+def osu_file(rng: random.Random, objects: int) -> str:
+    hit_objects = '\n'.join(f'{rng.randint(0, 512)},{rng.randint(0, 384)},{1000 + i * 300},1,0,0:0:0:0:'
+                            for i in range(objects))
+    return (
+        'osu file format v14\n\n'
+        '[General]\nAudioFilename: audio.mp3\nMode: 0\n\n'
+        '[Metadata]\nTitle:benchmark\nArtist:benchmark\nCreator:benchmark\nVersion:benchmark\n\n'
+        f'[Difficulty]\nHPDrainRate:{rng.randint(3, 8)}\nCircleSize:{rng.randint(3, 6)}\n'
+        f'OverallDifficulty:{rng.randint(5, 10)}\nApproachRate:{rng.randint(7, 10)}\n'
+        'SliderMultiplier:1.4\nSliderTickRate:1\n\n'
+        '[TimingPoints]\n0,300,4,2,0,100,1,0\n\n'
+        f'[HitObjects]\n{hit_objects}\n'
+    )
+
+
+def generate(root: str, scores: int, maps: int, users: int, seed: int):
+    """Synthetic source & target databases, .osu folder and replay folders under root."""
+    import fakedb
+
+    rng = random.Random(seed)
+    for folder in ('osu', 'osr_vn', 'osr_rx', 'osr_ap', 'bancho/.data/osr'):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+    source = fakedb.FakePool(os.path.join(root, 'source.db'))
+    target = fakedb.FakePool(os.path.join(root, 'target.db'))
+    for statement in SOURCE_SCHEMA:
+        source.db.execute(statement)
+    for statement in TARGET_SCHEMA:
+        target.db.execute(statement)
+
+    beatmaps = []
+    for map_id in range(1, maps + 1):
+        objects = rng.randint(100, 600)
+        content = osu_file(rng, objects)
+        md5 = hashlib.md5(content.encode()).hexdigest()
+        row = (map_id, md5, rng.choice((2, 2, 2, 3, 5)), objects * 300 // 1000)
+        if rng.random() < 0.98:  # the rest lack an entry in maps
+            source.db.execute('insert into maps values (?, ?, ?, ?)', row)
+            target.db.execute('insert into maps values (?, ?, ?, ?)', row)
+        if rng.random() < 0.98:  # the rest lack a .osu file
+            with open(os.path.join(root, 'osu', f'{map_id}.osu'), 'w') as f:
+                f.write(content)
+        beatmaps.append((md5, objects))
+
+    target.db.executemany('insert into users values (?)', [(user_id,) for user_id in range(1, users + 1)])
+    target.db.executemany('insert into stats (id, mode) values (?, ?)',
+                          [(user_id, mode) for user_id in range(1, users + 1) for mode in MODES])
+
+    score_id = 0
+    for table_name, count in (('scores_vn', scores * 6 // 10), ('scores_rx', scores * 3 // 10),
+                              ('scores_ap', scores - scores * 6 // 10 - scores * 3 // 10)):
+        rows = []
+        for _ in range(count):
+            score_id += 1
+            md5, objects = rng.choice(beatmaps)  # uniform, popular maps are covered by repeats at small map counts
+            nmiss = rng.choice((0, 0, 0, 1, 2, 5))
+            n100 = rng.randint(0, objects // 10)
+            n50 = rng.randint(0, objects // 50)
+            n300 = max(objects - n100 - n50 - nmiss, 0)
+            acc = 100 * (300 * n300 + 100 * n100 + 50 * n50) / (300 * max(objects, 1))
+            grade = 'F' if rng.random() < 0.1 else rng.choice(('S', 'A', 'B'))
+            mode = 0
+            if table_name != 'scores_ap' and rng.random() < 0.2:
+                mode = rng.randint(1, 3 if table_name == 'scores_vn' else 2)  # no rx!mania, ap is std only
+            rows.append((score_id, md5, rng.randint(10_000, 10_000_000), 0.0, acc, objects - nmiss,
+                         rng.choice(TABLE_MODS[table_name]), n300, n100, n50, nmiss, 0, 0, grade,
+                         rng.choice((0, 1, 2, 2)), mode, 1_600_000_000 + score_id, rng.randint(0, 300_000), 0,
+                         rng.randint(1, users), int(nmiss == 0), hashlib.md5(str(score_id).encode()).hexdigest()))
+            if grade != 'F' and rng.random() < 0.9:  # the rest lack a replay
+                with open(os.path.join(root, 'osr_' + table_name[-2:], f'{score_id}.osr'), 'wb') as f:
+                    f.write(rng.randbytes(256))
+        source.db.executemany(f'insert into {table_name} values ({", ".join("?" * 22)})', rows)
+    source.close()
+    target.close()
+
+
+def load_config(root: str, workers: int):
+    """Import ext/config.example.py as `config`, pointed at the generated folders."""
+    spec = importlib.util.spec_from_file_location('config', os.path.join(os.path.dirname(__file__), 'ext',
+                                                                         'config.example.py'))
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    config.osu_file_folder = os.path.join(root, 'osu') + '/'
+    config.replay_folder = root + '/'
+    config.new_bancho_folder = os.path.join(root, 'bancho') + '/'
+    config.pp_cache_path = None
+    config.osu_store_folder = os.path.join(root, 'osu_store') + '/'
+    config.calc_workers = workers
+    config.metrics_folder = os.path.join(root, 'metrics')
+    sys.modules['config'] = config
+
+
+class RssSampler:
+    """Highest resident set size of this process while the block runs, read from /proc every interval seconds.
+
+    peak_kb stays None where /proc is not available."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak_kb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _rss_kb(self) -> int:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+    def _sample(self):
+        while True:
+            self.peak_kb = max(self.peak_kb or 0, self._rss_kb())
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self) -> 'RssSampler':
+        if os.path.exists('/proc/self/statm'):
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+            self._sample()  # the last word after the phase's final allocations
+
+
+async def run(root: str, verbose: bool, use_snapshot: bool) -> dict:
+    import fakedb
+    import limiter
+    import main
+    import metrics
+    import profiling
+    import snapshot
+    import stored
+
+    stored.source_pool = fakedb.FakePool(os.path.join(root, 'source.db'))
+    stored.target_pool = fakedb.FakePool(os.path.join(root, 'target.db'))
+    if not verbose:
+        main.log = lambda string: None
+    snapshot_folder = None
+    if use_snapshot:
+        snapshot_folder = os.path.join(root, 'snapshot')
+        limiter.create_limiters(stored.source_pool.maxsize, stored.target_pool.maxsize, 0)
+        await snapshot.export(snapshot_folder, 1000)
+    await main.prepare(snapshot_folder=snapshot_folder)
+    scores = sum(stored.source_pool.db.execute(f'select count(*) as n from {table_name}').fetchone()['n']
+                 for table_name in ('scores_vn', 'scores_rx', 'scores_ap'))
+
+    phases = {}
+    tracemalloc.start()
+    for name, phase in (('scores', main.run_scores_update), ('stats', main.run_stats_update),
+                        ('rank', main.run_rank_update)):
+        tracemalloc.reset_peak()
+        round_trips = stored.source_pool.round_trips + stored.target_pool.round_trips
+        started = time.perf_counter()
+        with RssSampler() as rss:
+            async with profiling.phase(name):
+                await phase()
+        elapsed = time.perf_counter() - started
+        round_trips = stored.source_pool.round_trips + stored.target_pool.round_trips - round_trips
+        phases[name] = {
+            'seconds': round(elapsed, 3),
+            'scores_per_sec': round(scores / elapsed, 1) if elapsed else None,
+            'round_trips': round_trips,
+            'round_trips_per_score': round(round_trips / scores, 4) if scores else None,
+            'peak_traced_kb': tracemalloc.get_traced_memory()[1] // 1024,
+            'peak_rss_kb': rss.peak_kb,  # during this phase only, calculation workers excluded
+            'step_seconds': {step: round(histogram.sum, 3) for step, histogram in metrics.registry.histograms.items()},
+        }
+    tracemalloc.stop()
+    main.shutdown()
+    return {'scores': scores, 'phases': phases}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__) or '.',
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the migration phases against a local stand-in database')
+    parser.add_argument('--scores', type=int, default=20000, help='source scores across scores_vn/rx/ap')
+    parser.add_argument('--maps', type=int, default=200)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=0, help='calc_workers for this run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--snapshot', action='store_true', help='export a snapshot first and migrate from it')
+    parser.add_argument('--load-data', action='store_true', help='write scores with LOAD DATA instead of INSERT')
+    parser.add_argument('--profile', metavar='DIR', help='write per-phase profiles to DIR, see profiling.py')
+    parser.add_argument('--output', help='also write the JSON report here')
+    parser.add_argument('--keep', action='store_true', help='keep the generated data directory')
+    parser.add_argument('--verbose', action='store_true', help='keep the migration log output')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='gulag-bench-')
+    generate(root, args.scores, args.maps, args.users, args.seed)
+    load_config(root, args.workers)
+    if args.load_data:
+        sys.modules['config'].score_insert_method = 'load_data'
+    if args.profile:
+        import profiling
+        profiling.enable(args.profile, sys.modules['config'].profile_interval,
+                         sys.modules['config'].profile_block_threshold)
+    report = {
+        'revision': git_revision(),
+        'parameters': {'scores': args.scores, 'maps': args.maps, 'users': args.users, 'workers': args.workers,
+                       'seed': args.seed, 'snapshot': args.snapshot, 'load_data': args.load_data},
+        **asyncio.run(run(root, args.verbose, args.snapshot)),
+    }
+    if args.keep:
+        report['data'] = root
+    else:
+        shutil.rmtree(root)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+from typing import Dict
+
+from aiomysql import DictCursor
+
+import stored
+from stored import db_context
+
+# Last committed source id per (phase, table or table shard), kept in the target database
+# so that it commits together with the rows it covers
+CREATE_TABLE = ('create table if not exists migration_checkpoints ('
+                'phase varchar(16) not null, '
+                'table_name varchar(96) not null, '
+                'last_id bigint not null, '
+                'primary key (phase, table_name))')
+
+
+async def prepare(resume: bool):
+    async with db_context(stored.target_pool) as (_, cur):
+        await cur.execute(CREATE_TABLE)
+        if not resume:
+            # delta marks outlive runs, they are what the next --delta run starts from
+            await cur.execute("delete from migration_checkpoints where phase != 'delta'")
+
+
+async def load(phase: str, table_name: str) -> int:
+    async with db_context(stored.target_pool) as (_, cur):
+        await cur.execute('select last_id from migration_checkpoints where phase=%s and table_name=%s',
+                          [phase, table_name])
+        row = await cur.fetchone()
+    return 0 if row is None else row['last_id']
+
+
+async def load_all(phase: str, prefix: str) -> Dict[str, int]:
+    async with db_context(stored.target_pool) as (_, cur):
+        await cur.execute('select table_name, last_id from migration_checkpoints where phase=%s and table_name like %s',
+                          [phase, prefix + '%'])
+        return {row['table_name']: row['last_id'] for row in await cur.fetchall()}
+
+
+async def save(cur: DictCursor, phase: str, table_name: str, last_id: int):
+    """Record progress on cur, inside whatever transaction the caller has open."""
+    await cur.execute('insert into migration_checkpoints (phase, table_name, last_id) values (%s, %s, %s) '
+                      'on duplicate key update last_id=greatest(last_id, values(last_id))',
+                      [phase, table_name, last_id])
+
+
+async def commit(phase: str, table_name: str, last_id: int):
+    async with db_context(stored.target_pool) as (_, cur):
+        await save(cur, phase, table_name, last_id)
+
+
+async def commit_many(phase: str, last_ids: Dict[str, int]):
+    async with db_context(stored.target_pool) as (conn, cur):
+        await conn.begin()
+        try:
+            for table_name, last_id in last_ids.items():
+                await save(cur, phase, table_name, last_id)
+            await conn.commit()
+        except:
+            await conn.rollback()
+            raise
@@ -0,0 +1,159 @@
+"""Score migration shared by several processes, on one host or many.
+
+`python main.py --coordinate` records the score shards as units in the target database's migration_leases table,
+and any number of `python main.py --worker` processes claim units, migrate them and mark them done. A claim is a
+lease for lease_seconds that its worker renews while it works; once it expires, because the worker died or lost
+the database, another worker claims the unit and continues from its scores checkpoint.
+
+Every claim increments the unit's token. Write transactions check the token before they commit (`fence`), so a
+worker that lost its lease can neither write rows nor move the checkpoint the unit's next owner started from."""
+import asyncio
+import os
+import socket
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from aiomysql import DictCursor
+
+import stored
+from scheduler import Shard
+from stored import db_context
+
+CREATE_LEASES = ('create table if not exists migration_leases ('
+                 'unit varchar(96) not null, '
+                 'owner varchar(96) null, '
+                 'token bigint not null default 0, '
+                 'expires_at bigint not null default 0, '
+                 'done tinyint not null default 0, '
+                 'claims int not null default 0, '
+                 'beats bigint not null default 0, '
+                 'primary key (unit))')
+# next free target score id; workers reserve blocks of it instead of each counting on from max(id)
+CREATE_IDS = ('create table if not exists migration_ids ('
+              'name varchar(16) not null, '
+              'next_id bigint not null, '
+              'primary key (name))')
+
+
+class LeaseLost(Exception):
+    """Another worker claimed the unit after this one's lease expired."""
+
+
+class Lease(NamedTuple):
+    shard: Shard
+    token: int
+
+
+owner = f'{socket.gethostname()}:{os.getpid()}'
+held: Dict[str, Lease] = {}  # unit -> lease of this process
+
+
+async def prepare(resume: bool):
+    async with db_context(stored.target_pool) as (_, cur):
+        await cur.execute(CREATE_LEASES)
+        await cur.execute(CREATE_IDS)
+        if not resume:
+            await cur.execute('delete from migration_leases')
+            await cur.execute('delete from migration_ids')
+
+
+async def plan(shards: List[Shard], next_id: int):
+    """Record shards as units, keeping the state of those already planned, then open the id counter.
+    Workers wait for the counter, so they never see half a plan."""
+    async with db_context(stored.target_pool) as (conn, cur):
+        await conn.begin()
+        try:
+            await cur.executemany('insert into migration_leases (unit) values (%s) on duplicate key update unit=unit',
+                                  [[shard.key] for shard in shards])
+            await cur.execute('insert into migration_ids (name, next_id) values (%s, %s) '
+                              'on duplicate key update next_id=greatest(next_id, values(next_id))', ['scores', next_id])
+            await conn.commit()
+        except:
+            await conn.rollback()
+            raise
+
+
+async def status() -> Optional[Dict[str, int]]:
+    """Unit counts by state, None until the coordinator has planned them."""
+    async with db_context(stored.target_pool) as (_, cur):
+        await cur.execute("select next_id from migration_ids where name='scores'")
+        if await cur.fetchone() is None:
+            return None
+        await cur.execute('select count(*) as total, coalesce(sum(done), 0) as done, '
+                          'coalesce(sum(case when done=0 and owner is not null and expires_at >= unix_timestamp() '
+                          'then 1 else 0 end), 0) as leased, '
+                          'coalesce(sum(case when claims > 1 then claims - 1 else 0 end), 0) as reclaims '
+                          'from migration_leases')
+        return {name: int(value) for name, value in (await cur.fetchone()).items()}
+
+
+async def claim(lease_seconds: float) -> Optional[Lease]:
+    """Lease the next unit that is neither done nor held under an unexpired lease."""
+    async with db_context(stored.target_pool) as (_, cur):
+        await cur.execute('select unit, token from migration_leases '
+                          'where done=0 and (owner is null or expires_at < unix_timestamp()) '
+                          'order by claims, unit limit 16')
+        for row in await cur.fetchall():
+            # compare and set on the token: of two workers after the same unit, one updates no row
+            await cur.execute('update migration_leases set owner=%s, token=token+1, '
+                              'expires_at=unix_timestamp()+%s, claims=claims+1 '
+                              'where unit=%s and token=%s and done=0 '
+                              'and (owner is null or expires_at < unix_timestamp())',
+                              [owner, lease_seconds, row['unit'], row['token']])
+            if cur.rowcount == 1:
+                lease = held[row['unit']] = Lease(Shard.from_key(row['unit']), row['token'] + 1)
+                return lease
+    return None
+
+
+async def renew(lease_seconds: float) -> List[Lease]:
+    """Extend every lease this process holds, returning those another worker has claimed since."""
+    lost = []
+    async with db_context(stored.target_pool) as (_, cur):
+        for unit, lease in list(held.items()):
+            await cur.execute('update migration_leases set expires_at=unix_timestamp()+%s, beats=beats+1 '
+                              'where unit=%s and token=%s', [lease_seconds, unit, lease.token])
+            if cur.rowcount != 1:
+                held.pop(unit, None)
+                lost.append(lease)
+    return lost
+
+
+async def keep_alive(lease_seconds: float, log: Callable[[str], None]):
+    """Renew this process's leases every third of lease_seconds until cancelled."""
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        for lease in await renew(lease_seconds):
+            log(f'{lease.shard.key}: lease lost, another worker took the unit over')
+
+
+async def fence(cur: DictCursor, unit: str):
+    """Make sure this process still holds unit, inside the caller's write transaction on cur.
+
+    The update locks the lease row until that transaction ends, so a claim of the unit either commits before it
+    and the write fails, or waits for it and the new owner starts after the write's checkpoint."""
+    lease = held.get(unit)
+    if lease is not None:
+        await cur.execute('update migration_leases set beats=beats+1 where unit=%s and token=%s', [unit, lease.token])
+    if lease is None or cur.rowcount != 1:
+        raise LeaseLost(unit)
+
+
+async def complete(lease: Lease) -> bool:
+    """Mark the unit done, unless another worker claimed it meanwhile."""
+    held.pop(lease.shard.key, None)
+    async with db_context(stored.target_pool) as (_, cur):
+        await cur.execute('update migration_leases set done=1, owner=null where unit=%s and token=%s',
+                          [lease.shard.key, lease.token])
+        return cur.rowcount == 1
+
+
+async def reserve_ids(count: int) -> range:
+    """Take the next count target score ids. Compare and set: concurrent workers never get the same id."""
+    async with db_context(stored.target_pool) as (_, cur):
+        while True:
+            await cur.execute("select next_id from migration_ids where name='scores'")
+            next_id = (await cur.fetchone())['next_id']
+            await cur.execute("update migration_ids set next_id=%s where name='scores' and next_id=%s",
+                              [next_id + count, next_id])
+            if cur.rowcount == 1:
+                return range(next_id, next_id + count)
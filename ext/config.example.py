@@ -1,15 +1,63 @@
 # MySQL Source Settings
 source_mysql_host = "localhost"
+source_mysql_port = 3306
 source_mysql_user = "gulag"
 source_mysql_password = "your_password"
 source_mysql_dbname = "gulag"
 
 # MySQL Target Settings
 target_mysql_host = "localhost"
+target_mysql_port = 3306
 target_mysql_user = "gulag"
 target_mysql_password = "your_password"
 target_mysql_dbname = "gulag"
 
+mysql_connect_timeout = 10  # seconds
+source_pool_size = 10  # connections per pool, the most reads / writes ever in flight at once
+target_pool_size = 10
+
 osu_file_folder = "/osu-server/gulag/.data/osu/"
 replay_folder = "/osu-server/gulag/.data/"
 new_bancho_folder = "/osu-server/bancho.py/"
+
+# Performance Settings
+score_batch_size = 1000  # scores fetched, calculated and written together
+read_ahead_batches = 4  # fetched batches waiting for calculation before reading pauses
+lack_flush_size = 500  # new maps_lack entries collected before they are written
+calculator_cache_size = 256  # parsed beatmaps kept alive between batches, per worker
+insert_transaction_size = 500  # score rows per INSERT transaction
+calc_workers = 4  # pp calculation processes, 0 calculates on the event loop
+pp_cache_path = "pp_cache.sqlite3"  # pp results kept between runs, None to always calculate
+# local copies of the .osu files of batches waiting for calculation, None to read osu_file_folder directly
+osu_store_folder = "/dev/shm/gulag-update-osu/"
+osu_prefetch_workers = 8  # threads copying .osu files into osu_store_folder
+osu_store_size = 512  # MiB of copies kept, oldest dropped first
+shards_per_table = 8  # id ranges each scores table is split into
+shard_workers = 8  # shards migrated at once, capped by the connection pool sizes
+lease_seconds = 60  # --worker leases on units, renewed every third of it
+id_block_size = 10000  # target score ids a --worker reserves at a time
+stats_chunk_size = 5000  # user ids per bulk stats UPDATE
+replay_workers = 8  # threads copying replays, 0 to copy them on the event loop
+# copy, hardlink, reflink or sendfile; hardlink & reflink need replay_folder and new_bancho_folder on one filesystem
+replay_transfer_method = "copy"
+# insert, or load_data for LOAD DATA LOCAL INFILE (needs local_infile enabled on the target server)
+score_insert_method = "insert"
+
+# Adaptive Concurrency Settings
+# in-flight source reads, target writes and calculation batches each start at 2, grow by one per round of
+# operations faster than these latencies and halve after a slower one or an error
+source_read_latency = 0.5  # seconds per page read
+target_write_latency = 1.0  # seconds per write transaction
+calculation_latency = 10.0  # seconds per calculation batch
+
+# Metrics Settings
+metrics_interval = 30  # seconds between rate / ETA lines
+metrics_folder = "metrics/"  # metrics-<phase>.json & .prom written at the end of each phase, None to skip
+
+# Profiling Settings, used with --profile
+profile_interval = 0.005  # seconds between stack samples
+profile_block_threshold = 0.1  # seconds the event loop may be held before it counts as blocked
+
+# Verification Settings, used with --verify
+verify_chunk_users = 500  # user ids per chunk, chunks whose counts or hashes differ are compared row by row
+verify_report_limit = 1000  # differences of each kind listed in the report, all of them are counted
@@ -0,0 +1,244 @@
+"""SQLite stand-in for the aiomysql pools in `stored`, used by benchmark.py.
+
+Only the surface the migration uses is implemented: Pool.acquire/release/maxsize, Connection.cursor/begin/
+commit/rollback and Cursor.execute/executemany/fetch*/async iteration. The MySQL statements the phases issue are
+rewritten to SQLite on the way in, and LOAD DATA LOCAL INFILE becomes an executemany of the file's rows.
+Every statement and transaction command counts as one round trip.
+
+Each pooled connection is a SQLite connection of its own, so begin/commit/rollback are real transactions and
+temporary tables are per connection, as in MySQL. SQLite has one writer at a time: a transaction holds the pool's
+write lock from begin to commit or rollback, and a write outside of one waits for it."""
+import asyncio
+import re
+import sqlite3
+import zlib
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from aiomysql import DataError, DictCursor, IntegrityError, SSDictCursor
+
+UPDATE_JOIN = re.compile(
+    r'update (\w+) (\w+) (?:inner join (\w+) (\w+) on (.+?) )?left join (\w+) (\w+) on (.+?) set (.+?) where (.+)$',
+    re.IGNORECASE | re.DOTALL)
+COALESCE_ASSIGNMENT = re.compile(r'\w+\.(\w+) = coalesce\((\w+)\.(\w+), 0\)', re.IGNORECASE)
+UPDATE_INNER_JOIN = re.compile(r'update (\w+) (\w+) inner join (\w+) (\w+) on (.+?) set (.+)$',
+                               re.IGNORECASE | re.DOTALL)
+ASSIGNMENT = re.compile(r'\w+\.(\w+) = (\w+)\.(\w+)', re.IGNORECASE)
+LOAD_DATA = re.compile(r'load data local infile %s into table (\w+) .*\((.+)\)$', re.IGNORECASE | re.DOTALL)
+TSV_ESCAPES = re.compile(r'\\(.)')
+
+
+def _update_join(match: re.Match) -> str:
+    """`update a x [inner join b y on ...] left join c z on ... set x.col = coalesce(z.col, 0) where ...`
+    becomes correlated subqueries, as SQLite has no joins in UPDATE."""
+    (table, alias, scope_table, scope_alias, scope_on,
+     source_table, source_alias, source_on, assignments, where) = match.groups()
+    sets = ', '.join(
+        f'{column} = coalesce((select {source_alias}.{source_column} from {source_table} {source_alias} '
+        f'where {source_on}), 0)'
+        for column, _, source_column in COALESCE_ASSIGNMENT.findall(assignments))
+    if scope_table is not None:
+        where += f' and exists (select 1 from {scope_table} {scope_alias} where {scope_on})'
+    return f'update {table} as {alias} set {sets} where {where}'
+
+
+def _update_inner_join(match: re.Match) -> str:
+    """`update a x inner join b y on ... set x.col = y.col` only touches rows with a match."""
+    table, alias, source_table, source_alias, source_on, assignments = match.groups()
+    sets = ', '.join(f'{column} = (select {source_alias}.{source_column} from {source_table} {source_alias} '
+                     f'where {source_on})'
+                     for column, _, source_column in ASSIGNMENT.findall(assignments))
+    return (f'update {table} as {alias} set {sets} '
+            f'where exists (select 1 from {source_table} {source_alias} where {source_on})')
+
+
+def translate(sql: str) -> str:
+    sql = sql.strip().replace('%s', '?')
+    match = UPDATE_JOIN.match(sql)
+    if match is not None:
+        return _update_join(match)
+    match = UPDATE_INNER_JOIN.match(sql)
+    if match is not None:
+        return _update_inner_join(match)
+    sql = re.sub(r'unix_timestamp\(\)', "cast(strftime('%s', 'now') as integer)", sql, flags=re.IGNORECASE)
+    sql = re.sub(r'^truncate table (\w+)', r'delete from \1', sql, flags=re.IGNORECASE)
+    sql = re.sub(r'^drop temporary table (\w+)', r'drop table temp.\1', sql, flags=re.IGNORECASE)
+    sql = re.sub(r'^create temporary table', 'create temp table', sql, flags=re.IGNORECASE)
+    duplicate = re.search(r' on duplicate key update (.+)$', sql, flags=re.IGNORECASE | re.DOTALL)
+    if duplicate is not None:
+        assignments = re.sub(r'values\((\w+)\)', r'excluded.\1', duplicate.group(1), flags=re.IGNORECASE)
+        assignments = re.sub(r'greatest\(', 'max(', assignments, flags=re.IGNORECASE)
+        sql = sql[:duplicate.start()] + f' on conflict do update set {assignments}'
+    return sql
+
+
+@contextmanager
+def _mysql_errors() -> Iterator[None]:
+    """Raise SQLite's constraint & type errors as the aiomysql ones the writer tells bad rows by."""
+    try:
+        yield
+    except sqlite3.IntegrityError as e:
+        raise IntegrityError(str(e)) from e
+    except sqlite3.InterfaceError as e:
+        raise DataError(str(e)) from e
+
+
+def _tsv_row(line: str) -> List[Optional[str]]:
+    return [None if field == '\\N' else TSV_ESCAPES.sub(lambda m: {'t': '\t', 'n': '\n'}.get(m[1], m[1]), field)
+            for field in line.rstrip('\n').split('\t')]
+
+
+def _dict_row(cursor: sqlite3.Cursor, row: tuple) -> Dict[str, Any]:
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path, isolation_level=None)
+    db.row_factory = _dict_row
+    # MySQL functions of verify.row_hash
+    db.create_function('crc32', 1, lambda value: zlib.crc32(str(value).encode()), deterministic=True)
+    db.create_function('concat_ws', -1, lambda separator, *values: separator.join(
+        str(value) for value in values if value is not None), deterministic=True)
+    db.execute('pragma journal_mode=wal')
+    db.execute('pragma synchronous=off')
+    return db
+
+
+def _reads(sql: str) -> bool:
+    return sql.lstrip()[:6].lower() in ('select', 'with ', 'pragma')
+
+
+class FakeCursor:
+    def __init__(self, conn: 'FakeConnection', as_dict: bool = True):
+        self._conn = conn
+        self._pool = conn.pool
+        self._as_dict = as_dict
+        self.description = None
+        self._cursor: Optional[sqlite3.Cursor] = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    async def execute(self, sql: str, args: Optional[Sequence] = None):
+        self._pool.round_trips += 1
+        if self._conn.in_transaction or _reads(sql):
+            self._execute(sql, args)
+        else:
+            async with self._pool.writing:
+                self._execute(sql, args)
+
+    def _execute(self, sql: str, args: Optional[Sequence]):
+        load = LOAD_DATA.match(sql.strip())
+        if load is not None:
+            # the file is read here, as the client side of LOAD DATA LOCAL would
+            table_name, columns = load.groups()
+            with open(args[0], encoding='utf-8') as f:
+                rows = [_tsv_row(line) for line in f]
+            with _mysql_errors():
+                self._cursor = self._conn.db.executemany(
+                    f'insert into {table_name} ({columns}) values ({", ".join("?" * len(columns.split(",")))})', rows)
+            self.rowcount = len(rows)
+            return
+        with _mysql_errors():
+            self._cursor = self._new_cursor().execute(translate(sql), list(args or []))
+        self.rowcount = self._cursor.rowcount
+        self.lastrowid = self._cursor.lastrowid
+        self.description = self._cursor.description
+
+    async def executemany(self, sql: str, args: List[Sequence]):
+        self._pool.round_trips += 1
+        if self._conn.in_transaction:
+            self._executemany(sql, args)
+        else:
+            async with self._pool.writing:
+                self._executemany(sql, args)
+
+    def _executemany(self, sql: str, args: List[Sequence]):
+        with _mysql_errors():
+            self._cursor = self._new_cursor().executemany(translate(sql), [list(row) for row in args])
+        self.rowcount = self._cursor.rowcount
+
+    def _new_cursor(self) -> sqlite3.Cursor:
+        cursor = self._conn.db.cursor()
+        if not self._as_dict:
+            cursor.row_factory = None  # plain tuples, as aiomysql's Cursor & SSCursor
+        return cursor
+
+    async def fetchone(self) -> Optional[Dict[str, Any]]:
+        return self._cursor.fetchone()
+
+    async def fetchmany(self, size: int) -> List[Dict[str, Any]]:
+        return self._cursor.fetchmany(size)
+
+    async def fetchall(self) -> List[Dict[str, Any]]:
+        return self._cursor.fetchall()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        row = self._cursor.fetchone()
+        if row is None:
+            raise StopAsyncIteration
+        return row
+
+    async def close(self):
+        self._cursor = None
+
+
+class FakeConnection:
+    def __init__(self, pool: 'FakePool'):
+        self.pool = pool
+        self.db = _connect(pool.path)
+        self.in_transaction = False
+
+    async def cursor(self, cursor_class=None) -> FakeCursor:
+        return FakeCursor(self, cursor_class is None or issubclass(cursor_class, (DictCursor, SSDictCursor)))
+
+    async def begin(self):
+        self.pool.round_trips += 1
+        await self.pool.writing.acquire()
+        self.db.execute('begin immediate')
+        self.in_transaction = True
+
+    async def commit(self):
+        self.pool.round_trips += 1
+        self._end('commit')
+
+    async def rollback(self):
+        self.pool.round_trips += 1
+        self._end('rollback')
+
+    def _end(self, command: str):
+        if not self.in_transaction:
+            return  # autocommit, as aiomysql's commit & rollback outside begin
+        self.in_transaction = False
+        try:
+            self.db.execute(command)
+        finally:
+            self.pool.writing.release()
+
+
+class FakePool:
+    def __init__(self, path: str, maxsize: int = 10):
+        self.path = path
+        self.db = _connect(path)  # for setting up and inspecting the database, outside the pool
+        self.maxsize = maxsize
+        self.round_trips = 0
+        self.writing = asyncio.Lock()
+        self._slots = asyncio.Semaphore(maxsize)
+        self._idle: List[FakeConnection] = []
+
+    async def acquire(self) -> FakeConnection:
+        await self._slots.acquire()
+        return self._idle.pop() if self._idle else FakeConnection(self)
+
+    async def release(self, conn: FakeConnection):
+        if conn.in_transaction:  # as a MySQL connection dropped mid-transaction
+            conn._end('rollback')
+        self._idle.append(conn)
+        self._slots.release()
+
+    def close(self):
+        for conn in self._idle:
+            conn.db.close()
+        self.db.close()
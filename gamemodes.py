@@ -2,13 +2,24 @@ from __future__ import annotations
 
 import functools
 from enum import IntEnum
+from typing import Sequence
+
+try:
+    import numpy as np
+except ImportError:  # the batch helpers fall back to the enum path
+    np = None
 
 __all__ = (
     "GAMEMODE_REPR_LIST",
     "GameMode",
+    "vanilla_modes",
+    "mode_offsets",
+    "bancho_modes",
 )
 
 from mods import Mods
+from mods import autopilot_mask
+from mods import relax_mask
 
 GAMEMODE_REPR_LIST = (
     "vn!std",
@@ -65,3 +76,28 @@ class GameMode(IntEnum):
 
     def __repr__(self) -> str:
         return GAMEMODE_REPR_LIST[self.value]
+
+
+def vanilla_modes(modes: Sequence[int]):
+    """GameMode.as_vanilla of every mode, as an int64 array without a GameMode per value.
+    A list of ints when numpy is not installed."""
+    if np is None:
+        return [GameMode(mode).as_vanilla for mode in modes]
+    modes = np.asarray(modes, dtype=np.int64)
+    return np.where(modes & GameMode.AUTOPILOT_OSU, modes - 8,
+                    np.where(modes & GameMode.RELAX_OSU, modes - 4, modes))
+
+
+def mode_offsets(mods: Sequence[int]):
+    """What GameMode.from_params adds to the vanilla mode: 8 for AP, 4 for RX, else 0.
+    An int64 array, or a list of ints when numpy is not installed."""
+    if np is None:
+        return [8 if m & Mods.AUTOPILOT else 4 if m & Mods.RELAX else 0 for m in mods]
+    return np.where(autopilot_mask(mods), 8, np.where(relax_mask(mods), 4, 0)).astype(np.int64)
+
+
+def bancho_modes(modes_vn: Sequence[int], mods: Sequence[int]):
+    """GameMode.from_params of every (mode_vn, mods) pair, without a GameMode per value."""
+    if np is None:
+        return [mode_vn + offset for mode_vn, offset in zip(modes_vn, mode_offsets(mods))]
+    return np.asarray(modes_vn, dtype=np.int64) + mode_offsets(mods)
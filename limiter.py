@@ -0,0 +1,112 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import config
+
+
+class Slot:
+    """One in-flight operation; set failed when the operation failed without raising."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.failed = False
+
+
+class AdaptiveLimiter:
+    """AIMD limit on concurrent operations against one resource.
+
+    Every operation that finishes under target_latency adds 1 / limit, so the limit grows by one per round of fast
+    operations. An error or a slower operation halves it, once per round: operations that started before the last
+    decrease do not decrease it again."""
+
+    def __init__(self, name: str, maximum: int, target_latency: float, initial: int = 2, minimum: int = 1):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.target_latency = target_latency
+        self._limit = float(min(max(initial, minimum), self.maximum))
+        self._in_flight = 0
+        self._changed = asyncio.Condition()
+        self._last_decrease = 0.0
+        self._latency: Optional[float] = None  # moving average
+        self.completed = 0
+        self.errors = 0
+        self.decreases = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[Slot]:
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        slot = Slot()
+        try:
+            yield slot
+        except BaseException:
+            slot.failed = True
+            raise
+        finally:
+            self._finish(slot)
+            async with self._changed:
+                self._in_flight -= 1
+                self._changed.notify_all()
+
+    def _finish(self, slot: Slot):
+        latency = time.monotonic() - slot.started
+        self._latency = latency if self._latency is None else self._latency * 0.9 + latency * 0.1
+        self.completed += 1
+        if slot.failed:
+            self.errors += 1
+        if slot.failed or latency > self.target_latency:
+            if slot.started > self._last_decrease:
+                self._limit = max(float(self.minimum), self._limit / 2)
+                self._last_decrease = time.monotonic()
+                self.decreases += 1
+        elif self._in_flight >= self.limit:  # only grow while the limit is what holds operations back
+            self._limit = min(float(self.maximum), self._limit + 1 / self._limit)
+
+    def state(self) -> dict:
+        return {
+            'limit': self.limit,
+            'in_flight': self._in_flight,
+            'minimum': self.minimum,
+            'maximum': self.maximum,
+            'latency': None if self._latency is None else round(self._latency, 4),
+            'target_latency': self.target_latency,
+            'completed': self.completed,
+            'errors': self.errors,
+            'decreases': self.decreases,
+        }
+
+    def __str__(self) -> str:
+        latency = '-' if self._latency is None else f'{self._latency * 1000:.0f}ms'
+        return (f'{self.name} {self._in_flight}/{self.limit} ({self.minimum}~{self.maximum}, '
+                f'{latency} of {self.target_latency * 1000:.0f}ms, {self.errors} errors)')
+
+
+source_reads: AdaptiveLimiter = None
+target_writes: AdaptiveLimiter = None
+calculations: AdaptiveLimiter = None
+
+
+def create_limiters(source_size: int, target_size: int, calc_workers: int):
+    """Limits for source page reads, target write transactions and pp calculation batches, each capped by what
+    backs it: the connection pool, or twice the calculation processes so one batch queues per process."""
+    global source_reads, target_writes, calculations
+    source_reads = AdaptiveLimiter('source reads', source_size, config.source_read_latency)
+    target_writes = AdaptiveLimiter('target writes', target_size, config.target_write_latency)
+    calculations = AdaptiveLimiter('calculations', max(1, 2 * calc_workers), config.calculation_latency)
+
+
+def summary() -> str:
+    return ', '.join(str(limiter) for limiter in (source_reads, target_writes, calculations) if limiter is not None)
+
+
+def states() -> dict:
+    return {limiter.name: limiter.state() for limiter in (source_reads, target_writes, calculations)
+            if limiter is not None}
@@ -1,14 +1,34 @@
+import argparse
 import asyncio
 import logging
+import math
 import os
 import time
-from shutil import copyfile
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
 
+import beatmaps
+import checkpoint
 import config
+import coordinator
+import limiter
+import metrics
+import osu_store
 import performance
+import pp_cache
+import profiling
+import replays
+import scheduler
+import snapshot
+import source
 import stored
-from gamemodes import GameMode
-from ppysb_pp_py import ScoreParams
+import verify
+import writer
+from aiomysql import SSCursor, SSDictCursor
+from gamemodes import bancho_modes
+from gamemodes import vanilla_modes
+from records import SELECT_SCORE, Score, score_decoder, score_params
 from stored import db_context
 
 
@@ -18,210 +38,699 @@ def log(string: str):
     logging.info(string)
 
 
-async def calc_diff(score: dict):
-    mode_vn = GameMode(score['mode']).as_vanilla
-    async with db_context(stored.source_pool) as (_, cur):
-        await cur.execute("select id from maps where md5=%s", [score['map_md5']])
-        row = await cur.fetchone()
-        if row is None:
-            await insert_queue(score['map_md5'], 'entry')
-            return score['pp']
-        else:
-            osu_file_path = config.osu_file_folder + f"{str(row['id'])}.osu"
-            if os.path.exists(osu_file_path):
-                pp = 0
-                try:
-                    param = ScoreParams(mods=score['mods'], acc=score['acc'], n300=score['n300'], n100=score['n100'],
-                                        n50=score['n50'],
-                                        nMisses=score['nmiss'], nKatu=score['nkatu'], combo=score['max_combo'],
-                                        score=score['score'])
-                    (result,) = performance.calculate(mode_vn, osu_file_path, [param])
-                    pp = result.pp
-                finally:
-                    return pp
-            else:
-                await insert_queue(score['map_md5'], 'file')
-                return score['pp']
-
-
-def handle_osr(table_name: str, score: dict, new_id: int):
-    if score['grade'] == 'F':
-        return  # Failed score has no replay
-    path = config.replay_folder
-    if table_name == 'scores_vn':
-        path += 'osr_vn'
-    if table_name == 'scores_rx':
-        path += 'osr_rx'
-    if table_name == 'scores_ap':
-        path += 'osr_ap'
-    path += f"/{score['id']}.osr"
-    if os.path.exists(path):
-        copyfile(path, config.new_bancho_folder + f".data/osr/{new_id}.osr")
+def find_osu_file(md5: str, score_count: int) -> Optional[str]:
+    with metrics.registry.timer('beatmap_lookup'):
+        osu_file_path = beatmaps.index.osu_file(md5)
+    if md5 not in beatmaps.index:
+        beatmaps.lacks.record(md5, 'entry', score_count)
+        return None
+    if osu_file_path is None:
+        beatmaps.lacks.record(md5, 'file', score_count)
+    return osu_file_path
+
+
+def prefetch_maps(scores: List[Score]):
+    """Start copying the .osu files of scores that are yet to be calculated into the osu_store."""
+    if osu_store.store is not None:
+        osu_store.store.prefetch({path for path in map(beatmaps.index.osu_file, {score.map_md5 for score in scores})
+                                  if path is not None})
+
+
+async def calc_diff(scores: List[Score]) -> List[float]:
+    """Calculate pp for a batch of scores, parsing each beatmap once."""
+    pps = [score.pp for score in scores]
+    groups = defaultdict(list)
+    # the whole batch's modes decoded at once, without a GameMode per score
+    modes_vn = vanilla_modes([score.mode for score in scores])
+    for idx, (score, mode_vn) in enumerate(zip(scores, modes_vn)):
+        groups[(score.map_md5, int(mode_vn))].append(idx)
+
+    found = []
+    for (md5, mode_vn), indexes in groups.items():
+        osu_file_path = find_osu_file(md5, len(indexes))
+        if osu_file_path is not None:  # otherwise keep the original pp
+            found.append((md5, mode_vn, osu_file_path, indexes))
+    if pp_cache.cache is not None:
+        # the batch's maps are checked together, not one after the other
+        valid = await asyncio.gather(*[pp_cache.cache.validate(md5, osu_file_path)
+                                       for md5, _, osu_file_path, _ in found])
     else:
-        log(f'Replay not exist: {path}')
+        valid = [False] * len(found)
+
+    jobs = []
+    job_keys = []
+    job_indexes = []
+    for (md5, mode_vn, osu_file_path, indexes), cacheable in zip(found, valid):
+        params = [score_params(scores[idx]) for idx in indexes]
+        if cacheable:
+            uncached = []
+            for idx, values, pp in zip(indexes, params, pp_cache.cache.lookup(md5, mode_vn, params)):
+                if pp is None:
+                    uncached.append((idx, values))
+                else:
+                    pps[idx] = pp
+            if not uncached:
+                continue
+            indexes, params = [idx for idx, _ in uncached], [values for _, values in uncached]
+        jobs.append((mode_vn, osu_file_path, params))
+        job_keys.append((md5, mode_vn) if cacheable else None)
+        job_indexes.append(indexes)
+
+    if beatmaps.lacks.should_flush:
+        await beatmaps.lacks.flush()
+
+    async with osu_store.in_use([osu_file_path for _, osu_file_path, _ in jobs]), limiter.calculations.slot():
+        with metrics.registry.timer('pp_calculation'):
+            results = await performance.pool.calculate(jobs)
+    metrics.registry.inc('pp_calculated', sum(len(params) for _, _, params in jobs))
+    for (_, _, params), key, indexes, job_pps in zip(jobs, job_keys, job_indexes, results):
+        for idx, pp in zip(indexes, job_pps):
+            pps[idx] = 0 if pp is None else pp  # a score whose calculation fails gets no pp
+        if key is not None:
+            pp_cache.cache.store(*key, params, job_pps)
+    return pps
+
+
+def score_row(score: Score, mode: int, pp: float) -> list:
+    """The target columns after id; source and target share the column order, so only pp & mode change."""
+    return [
+        score.map_md5,
+        score.score,
+        min(pp, 8192),
+        *score[4:15],  # acc ~ status
+        mode,
+        *score[16:],  # play_time ~ online_checksum
+    ]
+
+
+async def insert_scores(shard: scheduler.Shard, scores: List[Score], previous: Optional[asyncio.Task] = None):
+    table_name = shard.table_name
+    pps = await calc_diff(scores)
+    if previous is not None:
+        await previous  # a shard commits its batches in source order
+    new_ids = list(await writer.writer.allocate(len(scores)))
+    # replays go first: once the checkpoint commits, this batch is never revisited
+    await replays.copier.copy(table_name, zip(scores, new_ids))
+    # the target mode carries the rx / ap offset of the score's mods, as GameMode.from_params
+    modes = bancho_modes([score.mode for score in scores], [score.mods for score in scores])
+    source_ids = [score.id for score in scores]
+    if snapshot.current is not None:
+        # the stats & rank phases aggregate these instead of rescanning the target scores. Recorded before the
+        # write, so that a batch whose checkpoint commits always has them, even if the run stops right after
+        snapshot.current.record_pp(table_name, source_ids, [min(pp, 8192) for pp in pps])
+    try:
+        written = await writer.writer.write([score_row(score, int(mode), pp)
+                                             for score, mode, pp in zip(scores, modes, pps)],
+                                            new_ids, shard.key, source_ids)
+    except coordinator.LeaseLost:
+        await replays.copier.discard(new_ids)  # the unit's new owner copies them again, under its own ids
+        raise
+    skipped = [(score_id, new_id) for score_id, new_id, written_id in zip(source_ids, new_ids, written)
+               if written_id is None]
+    await replays.copier.discard([new_id for _, new_id in skipped])
+    if snapshot.current is not None and skipped:
+        snapshot.current.record_pp(table_name, [score_id for score_id, _ in skipped], [math.nan] * len(skipped))
+
+
+async def migrate_shard(shard: scheduler.Shard, last_id: int, progress: scheduler.Progress):
+    pending, done = set(), set()
+    previous = None
+    queue = asyncio.Queue(maxsize=config.read_ahead_batches)
+    reader = asyncio.create_task(source.read_scores(queue, shard.table_name, config.score_batch_size,
+                                                    last_id, shard.end_id, prefetch_maps))
+    try:
+        while (batch := await queue.get()) is not None:
+            # calculate the next batch while the previous one is written
+            if len(pending) > 1:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()  # stop at the first failed batch, --resume continues from its checkpoint
+            previous = asyncio.create_task(insert_scores(shard, batch, previous))
+            pending.add(previous)
+            metrics.registry.inc('scores', len(batch))
+            log(progress.add(shard, len(batch)))
+        await asyncio.gather(*pending)
+        await reader
+    except BaseException:
+        # a --worker goes on with other units: stop the reader, room for its closing None, and let the batches
+        # in flight fail after the failed one they wait for
+        reader.cancel()
+        while not queue.empty():
+            queue.get_nowait()
+        await asyncio.gather(*pending, *done, return_exceptions=True)
+        raise
+    log(progress.finish(shard))
+
+
+@asynccontextmanager
+async def phase_metrics(phase: str, counter: str, total: Optional[int] = None):
+    """Fresh metrics for a phase, a rate / ETA line every metrics_interval seconds and an export at its end."""
+    metrics.registry.start_phase(phase, total)
+    reporter = asyncio.create_task(metrics.registry.report(log, counter, config.metrics_interval, limiter.summary))
+    try:
+        yield
+    finally:
+        reporter.cancel()
+        log(metrics.registry.rate_line(counter))
+        log(f'concurrency: {limiter.summary()}')
+        metrics.registry.export(config.metrics_folder)
+
 
+async def plan_scores(delta: bool = False) -> Dict[scheduler.Shard, int]:
+    shards = {}
+    for table_name in ['scores_vn', 'scores_rx', 'scores_ap']:
+        after_id = await checkpoint.load('delta', table_name) if delta else 0
+        shards.update(await scheduler.plan_shards(table_name, config.shards_per_table, after_id))
+    return shards
 
-def get_mode(table_name: str, mode: int) -> int:
-    if table_name == 'scores_vn':
-        return mode
-    if table_name == 'scores_rx':
-        return mode + 4
-    if table_name == 'scores_ap':
-        return mode + 8
 
+async def run_scores_update(delta: bool = False):
+    shards = await plan_scores(delta)
+    progress = scheduler.Progress(list(shards))
+    concurrency = scheduler.concurrency_limit(config.shard_workers)
+    total = sum([await source.count_scores(shard.table_name, last_id, shard.end_id)
+                 for shard, last_id in shards.items()])
+    log(f'Now handling: {total} scores in {len(shards)} shards of scores_vn, scores_rx & scores_ap, '
+        f'{concurrency} at once')
+    async with phase_metrics('scores', 'scores', total):
+        await scheduler.run_shards(list(shards), lambda shard: migrate_shard(shard, shards[shard], progress),
+                                   concurrency)
+    log(f"{progress.total} scores are handled, scores_vn, scores_rx & scores_ap are finished")
+    await beatmaps.lacks.flush()
+    log(beatmaps.lacks.summary())
+    log(replays.copier.summary())
+    if pp_cache.cache is not None:
+        log(pp_cache.cache.summary())
+    if osu_store.store is not None:
+        log(osu_store.store.summary())
+    # high-water marks for the next --delta run
+    await checkpoint.commit_many('delta', {shard.table_name: shard.end_id for shard in sorted(shards)})
 
-async def insert_queue(md5: str, lack_type: str):
+
+async def discard_unwritten_replays(after_id: int) -> int:
+    """Remove replays above after_id without a score row, copied by a worker that was killed before the write."""
+    candidates = sorted(new_id for new_id in replays.list_replays(config.new_bancho_folder + ".data/osr/")
+                        if new_id > after_id)
+    discarded = 0
+    for start in range(0, len(candidates), 1000):
+        chunk = candidates[start:start + 1000]
+        async with db_context(stored.target_pool) as (_, cur):
+            await cur.execute(f'select id from scores where id in ({", ".join(["%s"] * len(chunk))})', chunk)
+            written = {row['id'] for row in await cur.fetchall()}
+        unwritten = [new_id for new_id in chunk if new_id not in written]
+        await replays.copier.discard(unwritten)
+        discarded += len(unwritten)
+    return discarded
+
+
+async def coordinate_scores_update(resume: bool = False, delta: bool = False):
+    """Plan the shards as units for --worker processes and wait until they have all been done."""
+    await coordinator.prepare(resume)
+    shards = await plan_scores(delta)
+    first_id = writer.writer.max_id + 1
+    await coordinator.plan(list(shards), first_id)
+    log(f'{len(shards)} units of scores_vn, scores_rx & scores_ap are planned, waiting for --worker processes')
+    while (state := await coordinator.status())['done'] < state['total']:
+        log(f"units: {state['done']} / {state['total']} done, {state['leased']} leased, "
+            f"{state['reclaims']} claimed again after an expired lease")
+        await asyncio.sleep(config.metrics_interval)
+    log(f"all {state['total']} units are done, {state['reclaims']} of them were claimed again")
+    # from where the run started, so a restarted coordinator also covers the units done before its restart
+    discarded = await discard_unwritten_replays(await checkpoint.load('replays', 'target'))
+    log(f'{discarded} replays without a score are discarded')
+    await checkpoint.commit_many('delta', {shard.table_name: shard.end_id for shard in sorted(shards)})
+
+
+async def work_units(progress: scheduler.Progress):
+    """Claim, migrate and complete units until every unit of the coordinator's plan is done."""
+    while True:
+        lease = await coordinator.claim(config.lease_seconds)
+        if lease is None:
+            state = await coordinator.status()
+            if state is not None and state['done'] == state['total']:
+                return
+            # no plan yet, or the remaining units are leased: one of them may expire
+            await asyncio.sleep(config.lease_seconds / 3)
+            continue
+        last_id = await checkpoint.load('scores', lease.shard.key)
+        log(f'{lease.shard.key} is claimed (token {lease.token}), continuing after id {last_id}')
+        try:
+            await migrate_shard(lease.shard, last_id, progress)
+        except coordinator.LeaseLost:
+            log(f'{lease.shard.key}: lease lost, the unit is left to its new owner')
+            continue
+        if not await coordinator.complete(lease):
+            log(f'{lease.shard.key}: lease lost after the last batch, its new owner completes the unit')
+
+
+async def run_worker():
+    await prepare(resume=True, id_block=config.id_block_size)
+    await coordinator.prepare(resume=True)
+    progress = scheduler.Progress([])
+    concurrency = scheduler.concurrency_limit(config.shard_workers)
+    log(f'Worker {coordinator.owner}: {concurrency} units at once')
+    keep_alive = asyncio.create_task(coordinator.keep_alive(config.lease_seconds, log))
+    try:
+        async with profiling.phase(f'scores-{os.getpid()}', log), phase_metrics('scores', 'scores'):
+            await asyncio.gather(*[work_units(progress) for _ in range(concurrency)])
+    finally:
+        keep_alive.cancel()
+    log(f'{progress.total} scores are handled in {progress.finished} units')
+    await beatmaps.lacks.flush()
+    log(replays.copier.summary())
+    if pp_cache.cache is not None:
+        log(pp_cache.cache.summary())
+    if osu_store.store is not None:
+        log(osu_store.store.summary())
+    shutdown()
+
+
+async def touched_pairs(after_id: int) -> Set[Tuple[int, int]]:
+    """(userid, mode) of every target score with id above after_id."""
     async with db_context(stored.target_pool) as (_, cur):
-        await cur.execute(f'insert into maps_lack (md5, lack_type) values (%s, %s) on duplicate key update md5=%s',
-                          [md5, lack_type, md5])
-
-
-async def run_scores_update():
-    async with db_context(stored.source_pool) as (_, cur):
-        for table_name in ['scores_vn', 'scores_rx', 'scores_ap']:
-            log(f'Now handling: {table_name}')
-            counter = 0
-            total = 0
-            await cur.execute(f'select * from {table_name}')
-            async for score in cur:
-                try:
-                    counter += 1
-                    total += 1
-                    if counter >= 1000:
-                        counter = 0
-                        log(f"{total} scores are handled")
-                    async with db_context(stored.target_pool) as (_, target_cur):
-                        pp = await calc_diff(score)
-                        if pp > 8192:
-                            pp = 8192
-                        await target_cur.execute(
-                            "INSERT INTO scores "
-                            "VALUES (NULL, "
-                            "%s, %s, %s, %s, "
-                            "%s, %s, %s, %s, "
-                            "%s, %s, %s, %s, "
-                            "%s, %s, %s, %s, "
-                            "%s, %s, %s, %s, "
-                            "%s)",
-                            [
-                                score['map_md5'],
-                                score['score'],
-                                pp,
-                                score['acc'],
-                                score['max_combo'],
-                                score['mods'],
-                                score['n300'],
-                                score['n100'],
-                                score['n50'],
-                                score['nmiss'],
-                                score['ngeki'],
-                                score['nkatu'],
-                                score['grade'],
-                                score['status'],
-                                get_mode(table_name, score['mode']),
-                                score['play_time'],
-                                score['time_elapsed'],
-                                score['client_flags'],
-                                score['userid'],
-                                score['perfect'],
-                                score['online_checksum'],
-                            ])
-                        handle_osr(table_name, score, target_cur.lastrowid)
-                except:
-                    continue
-            log(f"{total} scores are handled, {table_name} is finished")
-
-
-async def run_stats_update():
-    log('begin total_hits & plays & play_time update')
-    count = 0
+        await cur.execute('select distinct userid, mode from scores where id > %s', [after_id])
+        return {(row['userid'], row['mode']) for row in await cur.fetchall()}
+
+
+async def stage_pairs(cur, pairs: Set[Tuple[int, int]]):
+    """Put pairs into a delta_pairs table on cur's connection, for the stats & rank phases to join against."""
+    await cur.execute('create temporary table if not exists delta_pairs ('
+                      'id int not null, mode tinyint not null, primary key (id, mode))')
+    await cur.execute('truncate table delta_pairs')
+    if pairs:
+        await cur.executemany('insert into delta_pairs (id, mode) values (%s, %s)', sorted(pairs))
+
+
+MODES = [0, 1, 2, 3, 4, 5, 6, 8]  # 7 is outdated
+
+
+async def user_range(phase: str, cur, pairs: Optional[Set[Tuple[int, int]]]) -> Tuple[int, int, Optional[int]]:
+    """(last handled user id, user count, last user id) for a phase, narrowed to the users of pairs if given."""
+    last_id = await checkpoint.load(phase, 'users')
+    if pairs is not None:
+        user_ids = {user_id for user_id, _ in pairs}
+        if not user_ids:
+            return last_id, 0, None
+        return max(last_id, min(user_ids) - 1), len(user_ids), max(user_ids)
+    await cur.execute('select count(*) as total, max(id) as max_id from users')
+    row = await cur.fetchone()
+    return last_id, row['total'], row['max_id']
+
+
+async def run_stats_update(pairs: Optional[Set[Tuple[int, int]]] = None):
+    log('begin total_hits & plays & play_time update'
+        + (f' of {len(pairs)} (user, mode) pairs' if pairs is not None else ''))
     async with db_context(stored.target_pool) as (_, cur):
-        await cur.execute('select count(*) from users')
-        total = (await cur.fetchone())["count(*)"]
-        await cur.execute('select id from users')
-        async for user in cur:
-            count += 1
-            log(f'Handle stats ({user["id"]}) {count} / {total}')
-            try:
-                for mode in [0, 1, 2, 3, 4, 5, 6, 8]:  # 7 is outdated
-                    async with db_context(stored.target_pool) as (_, cur1):
-                        await cur1.execute(
-                            f'SELECT SUM(n300 + n100 + n50 + ngeki + nkatu), COUNT(*) FROM scores WHERE userid=%s and mode=%s',
-                            [user['id'], mode])
-                        row_list = list((await cur1.fetchone()).values())
-                        total_hits = row_list[0] if row_list[0] is not None else 0
-                        plays = row_list[1]
-                        await cur1.execute(
-                            'select sum(total_length) from scores inner join maps on scores.map_md5 = maps.md5 where grade!=%s and scores.mode=%s and userid=%s',
-                            ['F', mode, user['id']])
-                        row_list = list((await cur1.fetchone()).values())
-                        total_length = row_list[0] if row_list[0] is not None else 0
-                        async with db_context(stored.target_pool) as (_, cur2):
-                            await cur2.execute('update stats set total_hits=%s where id=%s and mode=%s',
-                                               [int(total_hits), user['id'], mode])
-                            await cur2.execute('update stats set plays=%s where id=%s and mode=%s',
-                                               [plays, user['id'], mode])
-                            await cur2.execute('update stats set playtime=%s where id=%s and mode=%s',
-                                               [total_length, user['id'], mode])
-            except:
-                continue
+        if pairs is not None:
+            await stage_pairs(cur, pairs)
+        # every (userid, mode) aggregate in one grouped scan, staged on this connection
+        await cur.execute('create temporary table if not exists stats_staging ('
+                          'id int not null, mode tinyint not null, '
+                          'total_hits bigint not null, plays int not null, playtime bigint not null, '
+                          'primary key (id, mode))')
+        await cur.execute('truncate table stats_staging')
+        if snapshot.current is not None and snapshot.current.covers_target and pairs is None:
+            # aggregated from the snapshot's columns, the target scores are not scanned
+            await cur.execute('select md5, total_length from maps')
+            maps = [(row['md5'], row['total_length']) for row in await cur.fetchall()]
+            count = await writer.load_data(cur, 'stats_staging', ('id', 'mode', 'total_hits', 'plays', 'playtime'),
+                                           snapshot.current.stats_rows(MODES, maps))
+        else:
+            await cur.execute(
+                'insert into stats_staging (id, mode, total_hits, plays, playtime) '
+                'select s.userid, s.mode, coalesce(sum(s.n300 + s.n100 + s.n50 + s.ngeki + s.nkatu), 0), '
+                "count(*), coalesce(sum(case when s.grade != 'F' then m.total_length else 0 end), 0) "
+                'from scores s left join maps m on s.map_md5 = m.md5 '
+                + ('inner join delta_pairs p on p.id = s.userid and p.mode = s.mode ' if pairs is not None else '') +
+                f'where s.mode in ({", ".join(map(str, MODES))}) '
+                'group by s.userid, s.mode')
+            count = cur.rowcount
+        log(f'{count} (user, mode) pairs are aggregated')
+
+        last_id, total, max_id = await user_range('stats', cur, pairs)
+        async with phase_metrics('stats', 'user_ids', max_id - last_id if max_id is not None else 0):
+            while max_id is not None and last_id < max_id:
+                end_id = last_id + config.stats_chunk_size
+                # users without scores in a mode are reset to 0, as before
+                with metrics.registry.timer('stats_update'):
+                    await cur.execute(
+                        'update stats st '
+                        + ('inner join delta_pairs p on p.id = st.id and p.mode = st.mode '
+                           if pairs is not None else '') +
+                        'left join stats_staging t on t.id = st.id and t.mode = st.mode '
+                        'set st.total_hits = coalesce(t.total_hits, 0), st.plays = coalesce(t.plays, 0), '
+                        'st.playtime = coalesce(t.playtime, 0) '
+                        f'where st.id > %s and st.id <= %s and st.mode in ({", ".join(map(str, MODES))}) '
+                        'and st.id in (select id from users where id > %s and id <= %s)',
+                        [last_id, end_id, last_id, end_id])
+                    await checkpoint.commit('stats', 'users', end_id)
+                metrics.registry.inc('user_ids', min(end_id, max_id) - last_id)
+                log(f'Handle stats (users {last_id + 1} ~ {end_id}) of {total} users')
+                last_id = end_id
+        await cur.execute('drop temporary table stats_staging')
     log('total_hits & plays & play_time update finished')
 
 
-async def run_rank_update():
-    log('begin rank & total_pp update')
-    count = 0
+def weighted_rank(top_100: List[Tuple[float, float]], total_scores: int) -> Tuple[int, float]:
+    """Total pp & acc from the (pp, acc) of a user's best 100 ranked scores and their ranked score count."""
+    # update total weighted accuracy
+    tot = div = 0
+    for i, (_, score_acc) in enumerate(top_100):
+        add = int((0.95 ** i) * 100)
+        tot += score_acc * add
+        div += add
+    acc = tot / (1 if div == 0 else div)
+
+    # update total weighted pp
+    weighted_pp = sum([score_pp * 0.95 ** i
+                       for i, (score_pp, _) in enumerate(top_100)])
+    bonus_pp = 416.6667 * (1 - 0.9994 ** total_scores)
+    pp = round(weighted_pp + bonus_pp)
+    return pp, acc
+
+
+async def ranked_groups(after_user_id: int, pairs: Optional[Set[Tuple[int, int]]]
+                        ) -> AsyncIterator[Tuple[int, int, List[Tuple[float, float]], int]]:
+    """(userid, mode, (pp, acc) of the best 100, ranked score count) of every (user, mode) above after_user_id
+    with ranked scores, ordered by userid & mode."""
+    if snapshot.current is not None and snapshot.current.covers_target and pairs is None:
+        async with db_context(stored.target_pool) as (_, cur):
+            await cur.execute('select md5 from maps where status = 2')
+            ranked_md5 = [row['md5'] for row in await cur.fetchall()]
+        for group in snapshot.current.rank_groups(MODES, ranked_md5, after_user_id):
+            yield group
+        return
+    # one ordered pass over every ranked score, holding a single (user, mode) group at a time
+    async with db_context(stored.target_pool, SSDictCursor) as (_, stream):
+        user_ids = sorted({user_id for user_id, _ in pairs}) if pairs is not None else []
+        await stream.execute(
+            # rounded to the target columns' float(7,3) & float(6,3), whatever the database holds; ties in pp are
+            # broken by acc, so the best 100 are the same in any row order and from snapshot.rank_groups
+            'SELECT s.userid, s.mode, round(s.pp, 3) AS pp, round(s.acc, 3) AS acc FROM scores s '
+            'INNER JOIN maps m ON s.map_md5 = m.md5 '
+            f'WHERE s.status = 2 AND m.status = 2 AND s.mode in ({", ".join(map(str, MODES))}) '  # only ranked
+            'AND s.userid > %s '
+            + (f'AND s.userid in ({", ".join(map(str, user_ids))}) ' if user_ids else '') +
+            'ORDER BY s.userid, s.mode, pp DESC, acc DESC',
+            [after_user_id])
+        group = None
+        top_100 = []
+        total_scores = 0
+        async for row in stream:
+            if (row['userid'], row['mode']) != group:
+                if group is not None:
+                    yield (*group, top_100, total_scores)
+                group = (row['userid'], row['mode'])
+                top_100 = []
+                total_scores = 0
+            total_scores += 1
+            if len(top_100) < 100:
+                top_100.append((row['pp'], row['acc']))
+        if group is not None:
+            yield (*group, top_100, total_scores)
+
+
+async def run_rank_update(pairs: Optional[Set[Tuple[int, int]]] = None):
+    log('begin rank & total_pp update' + (f' of {len(pairs)} (user, mode) pairs' if pairs is not None else ''))
+    results = []
+
     async with db_context(stored.target_pool) as (_, cur):
-        await cur.execute('select count(*) from users')
-        total = (await cur.fetchone())["count(*)"]
-        await cur.execute('select id from users')
-        async for user in cur:
-            count += 1
-            log(f'Handle rank ({user["id"]}) {count} / {total}')
+        if pairs is not None:
+            await stage_pairs(cur, pairs)
+        await cur.execute('create temporary table if not exists rank_staging ('
+                          'id int not null, mode tinyint not null, pp int not null, acc float not null, '
+                          'primary key (id, mode))')
+        flushed_id, total, max_id = await user_range('rank', cur, pairs)
+
+        async def flush(end_id: int):
+            # every (user, mode) in the range without ranked scores gets 0, as before
+            nonlocal flushed_id, results
+            with metrics.registry.timer('rank_update'):
+                await cur.execute('truncate table rank_staging')
+                if results:
+                    await cur.executemany('insert into rank_staging (id, mode, pp, acc) values (%s, %s, %s, %s)',
+                                          results)
+                await cur.execute(
+                    'update stats st '
+                    + ('inner join delta_pairs p on p.id = st.id and p.mode = st.mode '
+                       if pairs is not None else '') +
+                    'left join rank_staging t on t.id = st.id and t.mode = st.mode '
+                    'set st.pp = coalesce(t.pp, 0), st.acc = coalesce(t.acc, 0) '
+                    f'where st.id > %s and st.id <= %s and st.mode in ({", ".join(map(str, MODES))}) '
+                    'and st.id in (select id from users where id > %s and id <= %s)',
+                    [flushed_id, end_id, flushed_id, end_id])
+                await checkpoint.commit('rank', 'users', end_id)
+            metrics.registry.inc('user_ids', min(end_id, max_id) - flushed_id)
+            log(f'Handle rank (users {flushed_id + 1} ~ {end_id}) of {total} users')
+            flushed_id = end_id
+            results = []
+
+        async with phase_metrics('rank', 'user_ids', max_id - flushed_id if max_id is not None else 0):
+            async for user_id, mode, top_100, total_scores in ranked_groups(flushed_id, pairs):
+                if user_id > flushed_id + config.stats_chunk_size:
+                    await flush(user_id - 1)
+                results.append([user_id, mode, *weighted_rank(top_100, total_scores)])
+            if max_id is not None and flushed_id < max_id:
+                await flush(max_id)
+        await cur.execute('drop temporary table rank_staging')
+    log('rank & total_pp update finished')
+
+
+REPP_TOLERANCE = 0.001  # pp is a float column, smaller differences are rounding
+
+
+async def write_pp(changes: List[Tuple[int, float]]):
+    """Apply (id, pp) pairs to scores in one joined UPDATE through a staging table."""
+    if not changes:
+        return
+    with metrics.registry.timer('target_update'):
+        async with db_context(stored.target_pool) as (conn, cur):
+            await cur.execute('create temporary table if not exists repp_staging ('
+                              'id int not null primary key, pp float not null)')
+            await cur.execute('truncate table repp_staging')
+            await conn.begin()
             try:
-                for mode in [0, 1, 2, 3, 4, 5, 6, 8]:  # 7 is outdated
-                    async with db_context(stored.target_pool) as (_, cur1):
-                        await cur1.execute(
-                            f'SELECT s.pp, s.acc FROM scores s '
-                            'INNER JOIN maps m ON s.map_md5 = m.md5 '
-                            'WHERE s.userid = %s AND s.mode = %s '
-                            'AND s.status = 2 AND m.status = 2 '  # only ranked
-                            'ORDER BY s.pp DESC',
-                            [user['id'], mode]
-                        )
-                        total_scores = cur1.rowcount
-                        top_100_pp = await cur1.fetchmany(100)
-                        # update total weighted accuracy
-                        tot = div = 0
-                        for i, row in enumerate(top_100_pp):
-                            add = int((0.95 ** i) * 100)
-                            tot += row['acc'] * add
-                            div += add
-                        acc = tot / (1 if div == 0 else div)
-
-                        # update total weighted pp
-                        weighted_pp = sum([row['pp'] * 0.95 ** i
-                                           for i, row in enumerate(top_100_pp)])
-                        bonus_pp = 416.6667 * (1 - 0.9994 ** total_scores)
-                        pp = round(weighted_pp + bonus_pp)
-                        async with db_context(stored.target_pool) as (_, cur2):
-                            await cur2.execute(
-                                f'UPDATE stats SET pp = %s, acc = %s '
-                                'WHERE id = %s AND mode = %s',
-                                [pp, acc, user['id'], mode]
-                            )
+                await cur.executemany('insert into repp_staging (id, pp) values (%s, %s)', changes)
+                await cur.execute('update scores s inner join repp_staging t on t.id = s.id set s.pp = t.pp')
+                await conn.commit()
             except:
-                continue
+                await conn.rollback()
+                raise
+    metrics.registry.inc('pp_changed', len(changes))
+
+
+async def repp_batch(batch: List[Score], pairs: Set[Tuple[int, int]]) -> List[Tuple[int, float]]:
+    """(id, pp) of the scores in batch whose recalculated pp differs from the stored one.
 
+    Adds the (userid, mode) of every changed ranked-status score to pairs."""
+    changes = []
+    # target modes already carry the rx / ap offset of bancho_modes, calc_diff only needs their vanilla mode
+    for score, pp in zip(batch, await calc_diff(batch)):
+        pp = min(pp, 8192)
+        if abs(pp - score.pp) > REPP_TOLERANCE:
+            changes.append((score.id, pp))
+            if score.status == 2:
+                pairs.add((score.userid, score.mode))
+    return changes
 
-async def run_task():
+
+async def run_repp_update(rank: bool = True):
+    """Recalculate pp of the scores already in the target database, map by map, writing only changed values.
+
+    Nothing is checkpointed: a rerun after an interruption finds the finished scores unchanged, and with the
+    pp cache enabled it does not calculate them again."""
+    async with db_context(stored.target_pool) as (_, cur):
+        await cur.execute('select count(*) as total from scores')
+        total = (await cur.fetchone())['total']
+    log(f'begin pp recalculation of {total} scores')
+    pairs = set()
+    handled = changed = 0
+    writing = None
+    batch = []
+
+    async def flush():
+        nonlocal writing, batch, handled, changed
+        changes = await repp_batch(batch, pairs)
+        if writing is not None:
+            await writing
+        writing = asyncio.create_task(write_pp(changes))  # written while the next batch calculates
+        handled += len(batch)
+        changed += len(changes)
+        metrics.registry.inc('scores', len(batch))
+        log(f'{handled} scores are recalculated, {changed} changed')
+        batch = []
+
+    async with phase_metrics('repp', 'scores', total):
+        async with db_context(stored.target_pool, SSCursor) as (_, stream):
+            # ordered by map, so a batch holds whole maps and each .osu file is parsed once per run
+            await stream.execute(f'SELECT {SELECT_SCORE} FROM scores ORDER BY map_md5')
+            decode = score_decoder(stream.description)
+            group = None
+            while rows := await stream.fetchmany(config.score_batch_size):
+                page = decode(rows)
+                prefetch_maps(page)
+                for score in page:
+                    if score.map_md5 != group and len(batch) >= config.score_batch_size:
+                        await flush()
+                    group = score.map_md5
+                    batch.append(score)
+            if batch:
+                await flush()
+        if writing is not None:
+            await writing
+    await beatmaps.lacks.flush()
+    log(f'pp recalculation finished: {changed} of {handled} scores changed, '
+        f'{len({user_id for user_id, _ in pairs})} users affected')
+    if pp_cache.cache is not None:
+        log(pp_cache.cache.summary())
+    if osu_store.store is not None:
+        log(osu_store.store.summary())
+    if rank and pairs:
+        await run_rank_update(pairs)
+
+
+async def prepare(resume: bool = False, snapshot_folder: Optional[str] = None, id_block: int = 0,
+                  repp: bool = False, coordinate: bool = False):
+    """Open everything a run uses. A --repp run works on the target database alone, its maps included."""
+    snapshot.open_snapshot(snapshot_folder)
+    await stored.create_pool(source=snapshot.current is None and not repp,
+                             local_infile=snapshot.current is not None or config.score_insert_method == 'load_data')
+    await checkpoint.prepare(resume)
+    if snapshot.current is not None:
+        if not resume:
+            snapshot.current.reset_migrated()
+            async with db_context(stored.target_pool) as (_, cur):
+                await cur.execute('select id from scores limit 1')
+                if await cur.fetchone() is None:
+                    await checkpoint.commit('snapshot', 'scores', 1)
+        # recorded once when the run starts, so that its resumed parts agree
+        snapshot.current.covers_target = await checkpoint.load('snapshot', 'scores') == 1
+        if not snapshot.current.covers_target:
+            log('target scores were not empty when the run started, stats & rank scan them instead of the snapshot')
+    await beatmaps.load_index(config.lack_flush_size, target=repp)
+    log(f'{len(beatmaps.index)} beatmaps are indexed')
+    osu_store.create_store(config.osu_store_folder, config.osu_prefetch_workers, config.osu_store_size)
+    performance.create_pool(config.calc_workers, config.calculator_cache_size, osu_store.folder)
+    limiter.create_limiters(stored.source_pool.maxsize if stored.source_pool is not None else 1,
+                            stored.target_pool.maxsize, performance.pool.workers)
+    pp_cache.open_cache(config.pp_cache_path)
+    await writer.create_writer(config.insert_transaction_size, config.score_insert_method, id_block)
+    replays.create_copier(config.replay_transfer_method, config.replay_workers, log)
+    if not resume:
+        # every target id of this run, resumed parts included, is above it
+        await checkpoint.commit('replays', 'target', writer.writer.max_id)
+    elif not id_block and not coordinate:
+        # batches that never committed copied replays under ids no score has, below other shards' rows as well.
+        # With --coordinate, workers may be between a replay copy and its write, so coordinate_scores_update
+        # does this once every unit is done.
+        discarded = await discard_unwritten_replays(await checkpoint.load('replays', 'target'))
+        log(f'{discarded} replays without a score are discarded')
+
+
+def shutdown():
+    if snapshot.current is not None:
+        snapshot.current.flush()
+    performance.pool.shutdown()
+    replays.copier.shutdown()
+    if osu_store.store is not None:
+        osu_store.store.shutdown()
+    if pp_cache.cache is not None:
+        pp_cache.cache.close()
+
+
+async def export_task(folder: str):
+    await stored.create_pool()
+    limiter.create_limiters(stored.source_pool.maxsize, stored.target_pool.maxsize, 0)
+    log(f'Exporting scores_vn, scores_rx, scores_ap & maps to {folder}')
+    await snapshot.export(folder, config.score_batch_size)
+    log(f'Snapshot is written to {folder}')
+
+
+async def verify_task(report_path: str):
     await stored.create_pool()
-    await run_scores_update()
-    await run_stats_update()
-    await run_rank_update()
+    limiter.create_limiters(stored.source_pool.maxsize, stored.target_pool.maxsize, 0)
+    verifier = verify.Verifier(verify.Report(config.verify_report_limit))
+    chunks = await verifier.plan(config.verify_chunk_users)
+    concurrency = scheduler.concurrency_limit(config.shard_workers)
+    log(f'Verifying scores_vn, scores_rx & scores_ap against scores in {len(chunks)} chunks of '
+        f'{config.verify_chunk_users} user ids, {concurrency} at once')
+    async with profiling.phase('verify', log), phase_metrics('verify', 'chunks', len(chunks)):
+        await verify.run(chunks, verifier, concurrency, log)
+    report = verifier.report
+    report.write(report_path)
+    log(f'{report.source_rows} source & {report.target_rows} target scores are compared, '
+        f'{len(report.chunks)} of {report.checked} chunks differ: '
+        + ', '.join(f'{count} {kind}' for kind, count in report.counts.items())
+        + f', report written to {report_path}')
+
+
+async def run_task(resume: bool = False, delta: bool = False, repp: bool = False, rank: bool = True,
+                   snapshot_folder: Optional[str] = None, coordinate: bool = False):
+    await prepare(resume, snapshot_folder, repp=repp, coordinate=coordinate)
+    if repp:
+        async with profiling.phase('repp', log):
+            await run_repp_update(rank)
+        shutdown()
+        return
+    pairs = None
+    if delta:
+        if not resume:
+            await checkpoint.commit('delta', 'target', writer.writer.max_id)
+        delta_floor = await checkpoint.load('delta', 'target')
+        log(f'Delta run: scores after the last migrated ids, target scores after id {delta_floor}')
+    async with profiling.phase('scores', log):
+        if coordinate:
+            await coordinate_scores_update(resume, delta)
+        else:
+            await run_scores_update(delta)
+    if delta:
+        pairs = await touched_pairs(delta_floor)
+    if pairs is None or pairs:
+        async with profiling.phase('stats', log):
+            await run_stats_update(pairs)
+        async with profiling.phase('rank', log):
+            await run_rank_update(pairs)
+    shutdown()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='update from ppysb gulag to ppysb next gen bancho.py')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoints of an interrupted run')
+    parser.add_argument('--delta', action='store_true',
+                        help='only migrate scores added since the last run, then update the users they touched')
+    parser.add_argument('--repp', action='store_true',
+                        help='recalculate pp of the scores already in bancho.py instead of migrating')
+    parser.add_argument('--skip-rank', action='store_true',
+                        help='with --repp, leave total pp & acc of the users whose scores changed as they are')
+    parser.add_argument('--export-snapshot', metavar='DIR',
+                        help='write the source score tables & maps to DIR as columns, then exit')
+    parser.add_argument('--snapshot', metavar='DIR',
+                        help='migrate from the snapshot in DIR instead of the source database')
+    parser.add_argument('--coordinate', action='store_true',
+                        help='let --worker processes migrate the scores, then update stats & rank')
+    parser.add_argument('--worker', action='store_true',
+                        help="migrate units of a --coordinate run's scores until all of them are done")
+    parser.add_argument('--verify', metavar='REPORT',
+                        help='compare the source score tables with the target scores, write the differences as JSON')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='write per-phase flamegraph stacks & event loop blocking summaries to DIR')
+    args = parser.parse_args()
+    if args.snapshot and args.delta:
+        parser.error('--delta reads the live source database, it cannot run from a snapshot')
+    if args.coordinate and (args.repp or args.snapshot):
+        parser.error('--coordinate only runs the migration from the source database')
+    if args.worker and (args.resume or args.delta or args.repp or args.snapshot or args.export_snapshot):
+        parser.error('a --worker takes its units, checkpoints & delta bounds from the --coordinate run')
+    if args.profile:
+        profiling.enable(args.profile, config.profile_interval, config.profile_block_threshold)
     logging.basicConfig(filename='script.log', encoding='utf-8', level=logging.INFO, format='%(asctime)s %(message)s')
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(run_task())
+    if args.export_snapshot:
+        loop.run_until_complete(export_task(args.export_snapshot))
+    elif args.verify:
+        loop.run_until_complete(verify_task(args.verify))
+    elif args.worker:
+        loop.run_until_complete(run_worker())
+    else:
+        loop.run_until_complete(run_task(args.resume, args.delta, args.repp, not args.skip_rank, args.snapshot,
+                                         args.coordinate))
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+# upper bounds in seconds, from a beatmap index lookup to a slow transaction
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[idx] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile."""
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return float('inf')
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(BUCKETS + ('+Inf',), self.counts)},
+        }
+
+
+class Metrics:
+    """Counters and latency histograms for the running phase.
+
+    Timed steps: source_fetch, beatmap_lookup, pp_calculation, target_insert, replay_copy, stats_update
+    and rank_update."""
+
+    def __init__(self):
+        self.phase = None
+        self.total: Optional[int] = None
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self._started = time.monotonic()
+
+    def start_phase(self, phase: str, total: Optional[int] = None):
+        self.phase = phase
+        self.total = total
+        self.counters = {}
+        self.histograms = {}
+        self._started = time.monotonic()
+
+    def inc(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._started
+
+    def rate_line(self, counter: str) -> str:
+        done = self.counters.get(counter, 0)
+        rate = done / self.elapsed if self.elapsed else 0
+        line = f'[{self.phase}] {int(done)} {counter} handled, {rate:.1f}/s'
+        if self.total and rate:
+            line += f', {done / self.total * 100:.1f}%, ETA {(self.total - done) / rate:.0f}s'
+        slowest = sorted(self.histograms.items(), key=lambda item: item[1].sum, reverse=True)[:3]
+        if slowest:
+            line += ', time in ' + ', '.join(f'{name} {histogram.sum:.1f}s' for name, histogram in slowest)
+        return line
+
+    async def report(self, log: Callable[[str], None], counter: str, interval: float,
+                     details: Optional[Callable[[], str]] = None):
+        """Log a rate / ETA line, followed by details() if given, every interval seconds until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            log(self.rate_line(counter) + (f' | {details()}' if details is not None else ''))
+
+    def as_dict(self) -> dict:
+        return {
+            'phase': self.phase,
+            'elapsed': round(self.elapsed, 3),
+            'total': self.total,
+            'counters': self.counters,
+            'histograms': {name: histogram.as_dict() for name, histogram in self.histograms.items()},
+        }
+
+    def prometheus(self) -> str:
+        lines = []
+        labels = f'phase="{self.phase}"'
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE gulag_migration_{name}_total counter')
+            lines.append(f'gulag_migration_{name}_total{{{labels}}} {value}')
+        for name, histogram in sorted(self.histograms.items()):
+            metric = f'gulag_migration_{name}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+        lines.append(f'gulag_migration_phase_seconds{{{labels}}} {self.elapsed}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, folder: Optional[str]):
+        """Write the phase's metrics as metrics-<phase>.json and a metrics-<phase>.prom textfile."""
+        if not folder:
+            return
+        os.makedirs(folder, exist_ok=True)
+        for ext, content in (('json', json.dumps(self.as_dict(), indent=2)), ('prom', self.prometheus())):
+            path = os.path.join(folder, f'metrics-{self.phase}.{ext}')
+            with open(path + '.tmp', 'w') as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)  # textfile collectors must never see a partial file
+
+
+registry = Metrics()
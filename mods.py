@@ -2,8 +2,20 @@ from __future__ import annotations
 
 import functools
 from enum import IntFlag
-
-__all__ = ("Mods",)
+from typing import Sequence
+
+try:
+    import numpy as np
+except ImportError:  # only the batch helpers need it, they fall back to the enum path
+    np = None
+
+__all__ = (
+    "Mods",
+    "filter_invalid_combos_batch",
+    "difficulty_keys",
+    "relax_mask",
+    "autopilot_mask",
+)
 
 # NOTE: the order of some of these = stupid
 
@@ -119,6 +131,13 @@ class Mods(IntFlag):
 
         return self
 
+    def difficulty_key(self, mode_vn: int) -> Mods:
+        """The mods a beatmap's difficulty depends on, e.g. HDNFNC -> DT."""
+        mods = self.filter_invalid_combos(mode_vn) & DIFFICULTY_MODS
+        if mods & Mods.NIGHTCORE:
+            mods = (mods & ~Mods.NIGHTCORE) | Mods.DOUBLETIME  # same clock rate
+        return mods
+
     @classmethod
     @functools.lru_cache(maxsize=64)
     def from_modstr(cls, s: str) -> Mods:
@@ -292,3 +311,74 @@ SPEED_CHANGING_MODS = Mods.DOUBLETIME | Mods.NIGHTCORE | Mods.HALFTIME
 OSU_SPECIFIC_MODS = Mods.AUTOPILOT | Mods.SPUNOUT | Mods.TARGET
 # taiko & catch have no specific mods
 MANIA_SPECIFIC_MODS = Mods.MIRROR | Mods.RANDOM | Mods.FADEIN | KEY_MODS
+
+# mods that change difficulty attributes, everything else only matters to the performance step
+DIFFICULTY_MODS = (
+    Mods.EASY | Mods.HARDROCK | SPEED_CHANGING_MODS | Mods.FLASHLIGHT | KEY_MODS | Mods.KEYCOOP
+)
+
+
+# batch helpers: whole columns of mods at once, as int64 arrays, without any Mods objects
+
+
+def _clear(mods: np.ndarray, where: np.ndarray, flags: int) -> np.ndarray:
+    return np.where(where, mods & ~int(flags), mods)
+
+
+def filter_invalid_combos_batch(mods: Sequence[int], modes_vn: Sequence[int]):
+    """Mods.filter_invalid_combos of every (mods, mode_vn) pair.
+
+    Returns an int64 array, or a list of ints without numpy."""
+    if np is None:
+        return [int(Mods(m).filter_invalid_combos(mode_vn)) for m, mode_vn in zip(mods, modes_vn)]
+    mods = np.asarray(mods, dtype=np.int64)
+    modes_vn = np.asarray(modes_vn, dtype=np.int64)
+
+    # 1. mode-inspecific mod conflictions
+    dtnc = mods & (Mods.DOUBLETIME | Mods.NIGHTCORE)
+    both = dtnc == (Mods.DOUBLETIME | Mods.NIGHTCORE)
+    mods = _clear(mods, both, Mods.DOUBLETIME)  # DTNC
+    mods = _clear(mods, ~both & (dtnc != 0) & (mods & Mods.HALFTIME != 0), Mods.HALFTIME)  # (DT|NC)HT
+    mods = _clear(mods, (mods & Mods.EASY != 0) & (mods & Mods.HARDROCK != 0), Mods.HARDROCK)  # EZHR
+    mods = _clear(mods, mods & (Mods.NOFAIL | Mods.RELAX | Mods.AUTOPILOT) != 0,
+                  Mods.SUDDENDEATH | Mods.PERFECT)  # (NF|RX|AP)SD, (NF|RX|AP)PF
+    mods = _clear(mods, mods & (Mods.RELAX | Mods.AUTOPILOT) != 0, Mods.NOFAIL)  # (RX|AP)NF
+    mods = _clear(mods, (mods & Mods.PERFECT != 0) & (mods & Mods.SUDDENDEATH != 0), Mods.SUDDENDEATH)  # PFSD
+
+    # 2. remove mode-unique mods from incorrect gamemodes
+    mods = _clear(mods, modes_vn != 0, OSU_SPECIFIC_MODS)
+    mods = _clear(mods, modes_vn != 3, MANIA_SPECIFIC_MODS)
+
+    # 3. mode-specific mod conflictions
+    mods = _clear(mods, (modes_vn == 0) & (mods & Mods.AUTOPILOT != 0)
+                  & (mods & (Mods.SPUNOUT | Mods.RELAX) != 0), Mods.AUTOPILOT)  # (SO|RX)AP
+    mods = _clear(mods, modes_vn == 3, Mods.RELAX)
+    mods = _clear(mods, (modes_vn == 3) & (mods & Mods.HIDDEN != 0) & (mods & Mods.FADEIN != 0),
+                  Mods.FADEIN)  # HDFI
+
+    # 4. keep only the first keymod, KEY_MODS iterates in bit order so that is the lowest set bit
+    keymods = mods & KEY_MODS
+    return (mods & ~int(KEY_MODS)) | (keymods & -keymods)
+
+
+def difficulty_keys(mods: Sequence[int], modes_vn: Sequence[int]):
+    """Mods.difficulty_key of every (mods, mode_vn) pair, an int64 array or a list of ints without numpy."""
+    if np is None:
+        return [int(Mods(m).difficulty_key(mode_vn)) for m, mode_vn in zip(mods, modes_vn)]
+    keys = filter_invalid_combos_batch(mods, modes_vn) & DIFFICULTY_MODS
+    nightcore = keys & Mods.NIGHTCORE != 0
+    return np.where(nightcore, (keys & ~int(Mods.NIGHTCORE)) | Mods.DOUBLETIME, keys)
+
+
+def relax_mask(mods: Sequence[int]):
+    """Which mods have RX set, a bool array or a list of bools without numpy."""
+    if np is None:
+        return [bool(m & Mods.RELAX) for m in mods]
+    return np.asarray(mods, dtype=np.int64) & Mods.RELAX != 0
+
+
+def autopilot_mask(mods: Sequence[int]):
+    """Which mods have AP set, a bool array or a list of bools without numpy."""
+    if np is None:
+        return [bool(m & Mods.AUTOPILOT) for m in mods]
+    return np.asarray(mods, dtype=np.int64) & Mods.AUTOPILOT != 0
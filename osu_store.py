@@ -0,0 +1,132 @@
+"""Read-ahead copies of .osu files in a local folder, on tmpfs (/dev/shm) by default.
+
+Pages are handed to `OsuStore.prefetch` as they are read, while earlier batches are still being calculated, and
+threads copy their maps' .osu files off the mirror. A calculation waits for the copies of its own batch, then
+every worker parses the local copy instead of the mirror's file: the binding opens it by path, or the worker reads
+it into its own memory and hands over the bytes (see performance.open_calculator). With the folder on tmpfs, that
+read never waits on a disk or the network. Copies are dropped oldest first beyond `max_bytes`, except those of
+calculations in flight.
+
+Each store keeps its copies in a subdirectory of its own under the configured folder, so the --worker processes
+of one host never drop or overwrite each other's, and removes only that subdirectory when it shuts down."""
+import asyncio
+import atexit
+import os
+import shutil
+import tempfile
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+import metrics
+
+folder: Optional[str] = None  # also set in calculation workers, see performance.init_worker
+
+
+def local_path(osu_file_path: str) -> Optional[str]:
+    """Path of the store's copy of osu_file_path, None if it has none (yet)."""
+    if folder is None:
+        return None
+    path = folder + os.path.basename(osu_file_path)
+    return path if os.path.exists(path) else None
+
+
+def _fetch(source: str, target: str) -> int:
+    shutil.copyfile(source, target + '.tmp')
+    os.replace(target + '.tmp', target)  # workers never open a partial copy
+    return os.path.getsize(target)
+
+
+class OsuStore:
+    def __init__(self, store_folder: str, workers: int, max_bytes: int):
+        global folder
+        os.makedirs(store_folder, exist_ok=True)
+        # a fresh directory: another process's copies are neither seen nor touched, a previous run's not reused
+        self.folder = folder = tempfile.mkdtemp(prefix=f'{os.getpid()}-', dir=store_folder) + '/'
+        atexit.register(shutil.rmtree, self.folder, ignore_errors=True)  # also when the run fails
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='osu')
+        self._loading: Dict[str, Future] = {}
+        self._stored: OrderedDict[str, int] = OrderedDict()  # mirror path -> copy size, oldest first
+        self._pins: Counter = Counter()
+        self.size = 0
+        self.fetched = 0
+        self.failed = 0
+        self.evicted = 0
+
+    def prefetch(self, osu_file_paths: Iterable[str]):
+        """Start copying the files not stored or being copied already."""
+        self._collect()
+        for path in osu_file_paths:
+            if path not in self._stored and path not in self._loading:
+                self._loading[path] = self._executor.submit(_fetch, path, folder + os.path.basename(path))
+
+    async def ready(self, osu_file_paths: Iterable[str]):
+        """Wait for the copies of osu_file_paths that are still being made."""
+        futures = [self._loading[path] for path in osu_file_paths if path in self._loading]
+        if futures:
+            with metrics.registry.timer('osu_prefetch_wait'):
+                await asyncio.gather(*[asyncio.wrap_future(future) for future in futures], return_exceptions=True)
+        self._collect()
+
+    @contextmanager
+    def pinned(self, osu_file_paths: Iterable[str]) -> Iterator[None]:
+        """Keep these copies while a calculation may open them."""
+        paths = list(osu_file_paths)
+        self._pins.update(paths)
+        try:
+            yield
+        finally:
+            self._pins.subtract(paths)
+            self._pins += Counter()  # drop zero counts
+
+    def _collect(self):
+        for path, future in list(self._loading.items()):
+            if not future.done():
+                continue
+            del self._loading[path]
+            if future.exception() is not None:
+                self.failed += 1  # calculations read the mirror's file instead
+                continue
+            self._stored[path] = future.result()
+            self.size += future.result()
+            self.fetched += 1
+        for path in list(self._stored):
+            if self.size <= self.max_bytes:
+                break
+            if self._pins[path]:
+                continue
+            os.remove(folder + os.path.basename(path))
+            self.size -= self._stored.pop(path)
+            self.evicted += 1
+
+    def summary(self) -> str:
+        return (f'.osu store: {self.fetched} files prefetched, {self.failed} failed, {self.evicted} evicted, '
+                f'{len(self._stored)} kept ({self.size / 2 ** 20:.1f} MiB)')
+
+    def shutdown(self):
+        global folder
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.folder, ignore_errors=True)
+        folder = None
+
+
+store: OsuStore = None
+
+
+def create_store(store_folder: Optional[str], workers: int, max_mib: int):
+    global store
+    if store is None and store_folder:
+        store = OsuStore(store_folder, workers, max_mib * 2 ** 20)
+
+
+@asynccontextmanager
+async def in_use(osu_file_paths: List[str]) -> AsyncIterator[None]:
+    """Around a calculation of these maps: wait for their copies, then keep them until it is done."""
+    if store is None:
+        yield
+        return
+    await store.ready(osu_file_paths)
+    with store.pinned(osu_file_paths):
+        yield
@@ -1,22 +1,213 @@
-from typing import List
+import asyncio
+import multiprocessing
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
 
 from ppysb_pp_py import CalculateResult, ScoreParams, Calculator
 
+import osu_store
 from mods import Mods
+from mods import difficulty_keys
 
 
-def calculate(mode_vn: int, osu_file_path: str, params: List[ScoreParams]) -> List[CalculateResult]:
-    calculator = Calculator(osu_file_path)
-    return_value = []
+class CalculatorCache:
+    """Bounded LRU of parsed beatmaps, keyed by .osu file path."""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._calculators: OrderedDict[str, Calculator] = OrderedDict()
+
+    def get(self, osu_file_path: str) -> Calculator:
+        calculator = self._calculators.get(osu_file_path)
+        if calculator is None:
+            calculator = open_calculator(osu_file_path)
+            self._calculators[osu_file_path] = calculator
+            if len(self._calculators) > self.maxsize:
+                self._calculators.popitem(last=False)
+        else:
+            self._calculators.move_to_end(osu_file_path)
+        return calculator
+
+    def clear(self):
+        self._calculators.clear()
+
+
+_accepts_bytes: Optional[bool] = None  # whether Calculator parses file content, found out on first use
+
+
+def open_calculator(osu_file_path: str) -> Calculator:
+    """Calculator of the map, parsed from the osu_store copy when there is one, else from the mirror's file."""
+    path = osu_store.local_path(osu_file_path)
+    if path is not None:
+        try:
+            return _open_copy(path)
+        except OSError:  # the copy was dropped after local_path found it
+            pass
+    return Calculator(osu_file_path)
+
+
+def _open_copy(path: str) -> Calculator:
+    global _accepts_bytes
+    if _accepts_bytes is False:
+        return Calculator(path)
+    with open(path, 'rb') as f:
+        content = f.read()
+    if _accepts_bytes is None:
+        try:
+            calculator = Calculator(content)
+        except (TypeError, ValueError, OSError):  # the binding only takes a path
+            _accepts_bytes = False
+            return Calculator(path)
+        _accepts_bytes = True
+        return calculator
+    return Calculator(content)
+
+
+def pp_mods(mods: int) -> int:
+    """Mods as calculate() sees them, V2 & NF makes not influence."""
+    return mods & ~(Mods.SCOREV2 | Mods.NOFAIL)
+
+
+_accepts_lists: Optional[bool] = None  # whether Calculator.calculate takes a list of params, found out on first use
+
+
+def _calculate_all(calculator: Calculator, params: List[ScoreParams]) -> List[CalculateResult]:
+    """One calculate() call for all params, so the binding can share their difficulty pass."""
+    global _accepts_lists
+    if _accepts_lists is not False and len(params) > 1:
+        try:
+            results = list(calculator.calculate(params))
+        except TypeError:  # the binding only takes one params at a time
+            if _accepts_lists:
+                raise
+            _accepts_lists = False
+        else:
+            _accepts_lists = True
+            return results
+    return [result for param in params for result in calculator.calculate(param)]
+
+
+def calculate(mode_vn: int, osu_file_path: str, params: List[ScoreParams],
+              cache: Optional[CalculatorCache] = None) -> List[CalculateResult]:
+    calculator = open_calculator(osu_file_path) if cache is None else cache.get(osu_file_path)
     for param in params:
         # V2 & NF makes not influence
-        if param.mods & Mods.SCOREV2:
-            param.mods &= ~Mods.SCOREV2
-        if param.mods & Mods.NOFAIL:
-            param.mods &= ~Mods.NOFAIL
-        (result,) = calculator.calculate(param)
+        if param.mods & (Mods.SCOREV2 | Mods.NOFAIL):
+            param.mods = pp_mods(param.mods)
+    return_value = _calculate_all(calculator, params)
+    for result in return_value:
         # Transform map should not gather any pp
         if result.mode != mode_vn:
             result.pp = 0
-        return_value.append(result)
     return return_value
+
+
+# (mods, acc, n300, n100, n50, nmiss, nkatu, combo, score), kept plain so it pickles
+ParamValues = Tuple[int, float, int, int, int, int, int, int, int]
+# (mode_vn, osu_file_path, params) for one beatmap
+CalcJob = Tuple[int, str, List[ParamValues]]
+
+_worker_cache: Optional[CalculatorCache] = None
+
+
+def normalize_params(values: ParamValues) -> ParamValues:
+    """Params as calculate() sees them, so scores differing only by V2/NF compare equal."""
+    mods, *rest = values
+    return (pp_mods(mods), *rest)
+
+
+def to_params(values: ParamValues) -> ScoreParams:
+    mods, acc, n300, n100, n50, nmiss, nkatu, combo, score = values
+    return ScoreParams(mods=mods, acc=acc, n300=n300, n100=n100, n50=n50,
+                       nMisses=nmiss, nKatu=nkatu, combo=combo, score=score)
+
+
+def calculate_pp(mode_vn: int, osu_file_path: str, params: List[ParamValues],
+                 cache: Optional[CalculatorCache] = None) -> List[Optional[float]]:
+    """pp of every params. Scores with identical inputs are calculated once, and those sharing a difficulty key
+    in one calculate() call.
+
+    None for the params whose calculation failed."""
+    distinct = list(dict.fromkeys(normalize_params(values) for values in params))
+    groups = defaultdict(list)
+    # the keys of the whole beatmap decoded at once, without a Mods per params
+    for values, key in zip(distinct, difficulty_keys([values[0] for values in distinct], [mode_vn] * len(distinct))):
+        groups[int(key)].append(values)
+    results = {}
+    for group in groups.values():
+        try:
+            pps = [result.pp for result in calculate(mode_vn, osu_file_path, [to_params(p) for p in group], cache)]
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException:  # a panic in the binding is a pyo3_runtime.PanicException, not an Exception
+            # Retry one by one, so a broken score only fails itself
+            pps = []
+            for values in group:
+                try:
+                    (result,) = calculate(mode_vn, osu_file_path, [to_params(values)], cache)
+                    pps.append(result.pp)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except BaseException:
+                    pps.append(None)
+        results.update(zip(group, pps))
+    return [results[normalize_params(values)] for values in params]
+
+
+def init_worker(cache_size: int, store_folder: Optional[str] = None):
+    global _worker_cache
+    _worker_cache = CalculatorCache(cache_size)
+    osu_store.folder = store_folder
+
+
+def calculate_jobs(jobs: List[CalcJob], cache: Optional[CalculatorCache] = None) -> List[List[Optional[float]]]:
+    cache = cache or _worker_cache
+    return [calculate_pp(mode_vn, osu_file_path, params, cache) for mode_vn, osu_file_path, params in jobs]
+
+
+class CalculationPool:
+    """Runs calculations on worker processes, each with its own CalculatorCache.
+
+    Jobs are routed by .osu path, so a beatmap always lands on the worker that has already parsed it.
+    With no workers, jobs are calculated inline on the caller's cache."""
+
+    def __init__(self, workers: int, cache_size: int, store_folder: Optional[str] = None):
+        self.cache = CalculatorCache(cache_size)
+        context = multiprocessing.get_context('spawn')
+        self._executors = [ProcessPoolExecutor(1, mp_context=context, initializer=init_worker,
+                                               initargs=(cache_size, store_folder)) for _ in range(workers)]
+
+    @property
+    def workers(self) -> int:
+        return len(self._executors)
+
+    async def calculate(self, jobs: List[CalcJob]) -> List[List[Optional[float]]]:
+        if not self._executors:
+            return calculate_jobs(jobs, self.cache)
+        shards = [[] for _ in self._executors]
+        for idx, job in enumerate(jobs):
+            shards[zlib.crc32(job[1].encode()) % len(shards)].append(idx)
+        loop = asyncio.get_running_loop()
+        shards = [(executor, shard) for executor, shard in zip(self._executors, shards) if shard]
+        futures = [loop.run_in_executor(executor, calculate_jobs, [jobs[idx] for idx in shard])
+                   for executor, shard in shards]
+        results = [None] * len(jobs)
+        for (_, shard), shard_results in zip(shards, await asyncio.gather(*futures)):
+            for idx, pps in zip(shard, shard_results):
+                results[idx] = pps
+        return results
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown()
+
+
+pool: CalculationPool = None
+
+
+def create_pool(workers: int, cache_size: int, store_folder: Optional[str] = None):
+    global pool
+    if pool is None:
+        pool = CalculationPool(workers, cache_size, store_folder)
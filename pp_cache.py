@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+from importlib import metadata
+from typing import Dict, List, Optional, Tuple
+
+import ppysb_pp_py
+
+import osu_store
+import performance
+
+SCHEMA = (
+    'create table if not exists meta (key text primary key, value text not null)',
+    'create table if not exists beatmaps (md5 text primary key, file_hash text not null)',
+    'create table if not exists results ('
+    'md5 text not null, mode integer not null, mods integer not null, acc real not null, '
+    'n300 integer not null, n100 integer not null, n50 integer not null, nmiss integer not null, '
+    'nkatu integer not null, combo integer not null, score integer not null, pp real not null, '
+    'primary key (md5, mode, mods, acc, n300, n100, n50, nmiss, nkatu, combo, score))',
+)
+COLUMNS = 'mods, acc, n300, n100, n50, nmiss, nkatu, combo, score'  # of the params, as in normalize_params
+LOOKUP_KEYS = 100  # params per lookup query, 9 variables each, within SQLite's default limit of 999
+FLUSH_ROWS = 10000  # results kept in memory before they are written in one transaction
+
+
+def calculator_version() -> str:
+    """Version of ppysb_pp_py, or the size & mtime of its binary when it is not installed as a distribution."""
+    try:
+        return metadata.version('ppysb_pp_py')
+    except metadata.PackageNotFoundError:
+        stat = os.stat(ppysb_pp_py.__file__)
+        return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def file_hash(osu_file_path: str) -> str:
+    with open(osu_file_path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def stored_file_hash(osu_file_path: str) -> str:
+    """file_hash of the osu_store's copy when there is one, the file the calculation reads, else of the mirror's."""
+    local = osu_store.local_path(osu_file_path)
+    if local is not None:
+        try:
+            return file_hash(local)
+        except OSError:  # dropped from the store meanwhile
+            pass
+    return file_hash(osu_file_path)
+
+
+class PPCache:
+    """pp results of earlier runs in a local SQLite file, keyed by map md5, mode and score parameters.
+
+    A map's results are dropped when its .osu file changes, and everything is dropped when the calculator
+    version changes."""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path)
+        self._db.execute('pragma journal_mode=wal')
+        self._db.execute('pragma synchronous=normal')
+        for statement in SCHEMA:
+            self._db.execute(statement)
+        self._validated: Dict[str, asyncio.Future] = {}
+        self._pending: Dict[Tuple, float] = {}  # (md5, mode, *params) -> pp, stored but not written yet
+        self.hits = 0
+        self.misses = 0
+
+        version = calculator_version()
+        row = self._db.execute("select value from meta where key='calculator_version'").fetchone()
+        if row is None or row[0] != version:
+            self._db.execute('delete from results')
+            self._db.execute('delete from beatmaps')
+            self._db.execute("insert or replace into meta (key, value) values ('calculator_version', ?)", [version])
+        self._db.commit()
+
+    async def validate(self, md5: str, osu_file_path: str) -> bool:
+        """Drop md5's results if its .osu file is not the one they were calculated from, checked once per run.
+
+        Returns False if the file can't be read, then the map is calculated without the cache."""
+        if md5 not in self._validated:
+            self._validated[md5] = asyncio.ensure_future(self._validate(md5, osu_file_path))
+        return await self._validated[md5]
+
+    async def _validate(self, md5: str, osu_file_path: str) -> bool:
+        if osu_store.store is not None:
+            await osu_store.store.ready([osu_file_path])  # prefetched with the batch, hashed off the local copy
+        try:
+            current = await asyncio.to_thread(stored_file_hash, osu_file_path)
+        except OSError:
+            return False
+        row = self._db.execute('select file_hash from beatmaps where md5=?', [md5]).fetchone()
+        if row is None or row[0] != current:
+            self._db.execute('delete from results where md5=?', [md5])
+            self._db.execute('insert or replace into beatmaps (md5, file_hash) values (?, ?)', [md5, current])
+            self._db.commit()
+        return True
+
+    def lookup(self, md5: str, mode_vn: int, params: List[performance.ParamValues]) -> List[Optional[float]]:
+        keys = [performance.normalize_params(values) for values in params]
+        cached = {key: self._pending[(md5, mode_vn, *key)] for key in keys if (md5, mode_vn, *key) in self._pending}
+        missing = list(set(keys).difference(cached))
+        for start in range(0, len(missing), LOOKUP_KEYS):
+            chunk = missing[start:start + LOOKUP_KEYS]
+            values = ', '.join(['(?, ?, ?, ?, ?, ?, ?, ?, ?)'] * len(chunk))
+            rows = self._db.execute(
+                f'with wanted ({COLUMNS}) as (values {values}) '
+                f'select {COLUMNS}, pp from results join wanted using ({COLUMNS}) where md5=? and mode=?',
+                [value for key in chunk for value in key] + [md5, mode_vn])
+            cached.update((tuple(row[:-1]), row[-1]) for row in rows)
+        pps = [cached.get(key) for key in keys]
+        hits = sum(pp is not None for pp in pps)
+        self.hits += hits
+        self.misses += len(pps) - hits
+        return pps
+
+    def store(self, md5: str, mode_vn: int, params: List[performance.ParamValues], pps: List[Optional[float]]):
+        """Keep the results of params, except failed calculations (None): those are retried next run."""
+        for values, pp in zip(params, pps):
+            if pp is not None:
+                self._pending[(md5, mode_vn, *performance.normalize_params(values))] = pp
+        if len(self._pending) >= FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._db.executemany('insert or replace into results values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 [(*key, pp) for key, pp in self._pending.items()])
+            self._db.commit()
+            self._pending.clear()
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f'pp cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)'
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+cache: Optional[PPCache] = None
+
+
+def open_cache(path: Optional[str]):
+    global cache
+    if cache is None and path:
+        cache = PPCache(path)
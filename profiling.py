@@ -0,0 +1,143 @@
+"""Sampling profiler and event-loop blocking detector for `python main.py --profile DIR`.
+
+A thread samples the stack of every other thread every `profile_interval` seconds and writes them per phase as
+profile-<phase>.folded, in the collapsed format flamegraph.pl, speedscope and inferno read. Meanwhile a heartbeat
+task on the event loop notices when it runs later than `profile_block_threshold`: whatever the loop thread was
+sampled doing in between held the loop, and profile-<phase>-blocking.json sums those stalls by stack.
+Calculation worker processes are not sampled, their time shows as waiting on the executor."""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from types import FrameType
+from typing import AsyncIterator, Dict, List, Optional
+
+folder: Optional[str] = None
+interval = 0.005
+block_threshold = 0.1
+
+
+def enable(profile_folder: str, sample_interval: float, threshold: float):
+    global folder, interval, block_threshold
+    folder, interval, block_threshold = profile_folder, sample_interval, threshold
+    os.makedirs(folder, exist_ok=True)
+
+
+def fold(frame: Optional[FrameType]) -> str:
+    """`file:function;...` from the outermost frame to frame."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Block:
+    def __init__(self, started: float):
+        self.started = started
+        self.stacks: Counter = Counter()
+
+
+class PhaseProfiler:
+    def __init__(self, phase: str):
+        self.phase = phase
+        self.samples: Counter = Counter()
+        self.blocks: List[dict] = []
+        self._loop_thread = threading.get_ident()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._last_tick = time.monotonic()
+        self._block: Optional[Block] = None
+        self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    def _sample(self):
+        names = {}
+        while not self._stop.wait(interval):
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self._sampler.ident:
+                    continue
+                stack = fold(frame)
+                self.samples[f'{names.get(ident, ident)};{stack}'] += 1
+                if ident == self._loop_thread:
+                    with self._lock:
+                        if time.monotonic() - self._last_tick > block_threshold:
+                            if self._block is None:
+                                self._block = Block(self._last_tick)
+                            self._block.stacks[stack] += 1
+
+    async def _beat(self):
+        tick = min(block_threshold / 2, 0.05)
+        while True:
+            await asyncio.sleep(tick)
+            now = time.monotonic()
+            with self._lock:
+                late = now - self._last_tick - tick
+                block, self._block = self._block, None
+                self._last_tick = now
+            if late > block_threshold:
+                self.blocks.append({
+                    'seconds': round(late, 4),
+                    'stacks': dict(block.stacks.most_common(3)) if block is not None else {},
+                })
+
+    async def start(self):
+        self._last_tick = time.monotonic()
+        self._heartbeat = asyncio.create_task(self._beat())
+        self._sampler.start()
+
+    async def stop(self):
+        self._stop.set()
+        self._heartbeat.cancel()
+        self._sampler.join()
+
+    def blocking_summary(self) -> dict:
+        by_stack: Dict[str, float] = Counter()
+        for block in self.blocks:
+            total = sum(block['stacks'].values())
+            for stack, count in block['stacks'].items():
+                by_stack[stack] += block['seconds'] * count / total  # split each stall by its samples
+        return {
+            'phase': self.phase,
+            'threshold': block_threshold,
+            'blocks': len(self.blocks),
+            'blocked_seconds': round(sum(block['seconds'] for block in self.blocks), 4),
+            'longest': max((block['seconds'] for block in self.blocks), default=0),
+            'by_stack': [{'seconds': round(seconds, 4), 'stack': stack}
+                         for stack, seconds in sorted(by_stack.items(), key=lambda item: -item[1])[:20]],
+        }
+
+    def write(self) -> dict:
+        with open(os.path.join(folder, f'profile-{self.phase}.folded'), 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f'{stack} {count}\n')
+        summary = self.blocking_summary()
+        with open(os.path.join(folder, f'profile-{self.phase}-blocking.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+@asynccontextmanager
+async def phase(name: str, log=None) -> AsyncIterator[Optional[PhaseProfiler]]:
+    """Profile the block as phase `name` when profiling is enabled, else do nothing."""
+    if folder is None:
+        yield None
+        return
+    profiler = PhaseProfiler(name)
+    await profiler.start()
+    try:
+        yield profiler
+    finally:
+        await profiler.stop()
+        summary = profiler.write()
+        if log is not None:
+            leaf = summary['by_stack'][0]['stack'].rsplit(';', 1)[-1] if summary['by_stack'] else '-'
+            log(f'[{name}] profile written to {folder}: event loop blocked {summary["blocks"]} times over '
+                f'{block_threshold * 1000:.0f}ms, {summary["blocked_seconds"]}s in all, mostly in {leaf}')
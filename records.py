@@ -0,0 +1,52 @@
+from datetime import datetime
+from operator import itemgetter
+from typing import Callable, List, NamedTuple, Sequence, Union
+
+
+class Score(NamedTuple):
+    """One score row, fields in gulag's and bancho.py's shared column order.
+
+    A tuple cursor row in this order becomes a Score without copying its values, and a Score is a fraction of the
+    size of the DictCursor dict it replaces."""
+    id: int
+    map_md5: str
+    score: int
+    pp: float
+    acc: float
+    max_combo: int
+    mods: int
+    n300: int
+    n100: int
+    n50: int
+    nmiss: int
+    ngeki: int
+    nkatu: int
+    grade: str
+    status: int
+    mode: int
+    play_time: Union[int, datetime]
+    time_elapsed: int
+    client_flags: int
+    userid: int
+    perfect: int
+    online_checksum: str
+
+
+SCORE_COLUMNS = Score._fields
+SELECT_SCORE = ', '.join(SCORE_COLUMNS)
+
+# (mods, acc, n300, n100, n50, nmiss, nkatu, combo, score), performance.ParamValues in one C call
+score_params: Callable[[Score], tuple] = itemgetter(*[SCORE_COLUMNS.index(name) for name in (
+    'mods', 'acc', 'n300', 'n100', 'n50', 'nmiss', 'nkatu', 'max_combo', 'score')])
+
+
+def score_decoder(description: Sequence[tuple]) -> Callable[[List[tuple]], List[Score]]:
+    """Decoder for the rows of a tuple cursor, through a column index map built once from its description.
+
+    Rows selected with SELECT_SCORE already are in Score order and are wrapped as they are."""
+    names = [column[0] for column in description]
+    positions = [names.index(name) for name in SCORE_COLUMNS]
+    if positions == list(range(len(SCORE_COLUMNS))) and len(names) == len(SCORE_COLUMNS):
+        return lambda rows: [tuple.__new__(Score, row) for row in rows]
+    reorder = itemgetter(*positions)
+    return lambda rows: [tuple.__new__(Score, reorder(row)) for row in rows]
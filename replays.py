@@ -0,0 +1,176 @@
+import asyncio
+import fcntl
+import os
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfile
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import config
+import metrics
+from records import Score
+
+REPLAY_FOLDERS = {
+    'scores_vn': 'osr_vn',
+    'scores_rx': 'osr_rx',
+    'scores_ap': 'osr_ap',
+}
+
+FICLONE = 0x40049409  # linux/fs.h, _IOW(0x94, 9, int)
+METHODS = ('copy', 'hardlink', 'reflink', 'sendfile')
+
+
+def list_replays(folder: str) -> Set[int]:
+    replay_ids = set()
+    if not os.path.isdir(folder):
+        return replay_ids
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext == '.osr' and name.isdigit():
+                replay_ids.add(int(name))
+    return replay_ids
+
+
+def target_path(new_id: int) -> str:
+    return config.new_bancho_folder + f".data/osr/{new_id}.osr"
+
+
+def _replace(target: str):
+    try:
+        os.remove(target)
+    except FileNotFoundError:
+        pass
+
+
+def _sendfile(source: str, target: str):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, remaining)
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+
+
+def _reflink(source: str, target: str):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def transfer(method: str, source: str, target: str):
+    if method == 'hardlink':
+        _replace(target)
+        os.link(source, target)
+    elif method == 'reflink':
+        try:
+            _reflink(source, target)
+        except OSError:
+            copyfile(source, target)  # the filesystem can't share extents
+    elif method == 'sendfile':
+        _sendfile(source, target)
+    else:
+        copyfile(source, target)
+
+
+class ReplayCopier:
+    """Copies replays into bancho.py's .data/osr/ on a thread pool, off the event loop.
+
+    Each source folder is listed once up front, so a missing replay costs no syscall.
+    Missing replays are counted per table and reported by summary() instead of logged one by one; failed transfers
+    are logged each. With no workers, replays are copied inline on the event loop."""
+
+    def __init__(self, method: str, workers: int, log: Optional[Callable[[str], None]] = None):
+        if method not in METHODS:
+            raise ValueError(f'replay_transfer_method must be one of {", ".join(METHODS)}')
+        if workers < 0:
+            raise ValueError('replay_workers must be 0 or more')
+        self.method = method
+        self.workers = workers
+        self.log = log
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='replay') if workers else None
+        self._available: Dict[str, Set[int]] = {}
+        self.copied = 0
+        self.failed = 0
+        self.missing: Dict[str, int] = {table_name: 0 for table_name in REPLAY_FOLDERS}
+        self.missing_examples: List[str] = []
+
+    def source_path(self, table_name: str, score_id: int) -> str:
+        return config.replay_folder + f"{REPLAY_FOLDERS[table_name]}/{score_id}.osr"
+
+    def load(self):
+        for table_name, folder in REPLAY_FOLDERS.items():
+            self._available[table_name] = list_replays(config.replay_folder + folder)
+
+    def _copy(self, jobs: List[Tuple[str, str]]) -> List[Tuple[str, str, OSError]]:
+        failures = []
+        for source, target in jobs:
+            try:
+                transfer(self.method, source, target)
+            except OSError as e:
+                failures.append((source, target, e))
+        return failures
+
+    def _discard(self, new_ids: List[int]) -> list:
+        for new_id in new_ids:
+            _replace(target_path(new_id))
+        return []
+
+    async def _run(self, func, jobs: list) -> list:
+        if not jobs:
+            return []
+        if self._executor is None:
+            return func(jobs)
+        loop = asyncio.get_running_loop()
+        size = -(-len(jobs) // self.workers)
+        parts = await asyncio.gather(*[loop.run_in_executor(self._executor, func, jobs[start:start + size])
+                                       for start in range(0, len(jobs), size)])
+        return [result for results in parts for result in results]
+
+    async def copy(self, table_name: str, scores: Iterable[Tuple[Score, int]]):
+        """Copy the replay of every (source score, new id) that has one."""
+        available = self._available[table_name]
+        jobs = []
+        for score, new_id in scores:
+            if score.grade == 'F':
+                continue  # Failed score has no replay
+            if score.id not in available:
+                self.missing[table_name] += 1
+                if len(self.missing_examples) < 10:
+                    self.missing_examples.append(self.source_path(table_name, score.id))
+                continue
+            jobs.append((self.source_path(table_name, score.id), target_path(new_id)))
+        with metrics.registry.timer('replay_copy'):
+            failures = await self._run(self._copy, jobs)
+        if self.log is not None:
+            for source, target, error in failures:
+                self.log(f'replay {source} -> {target} failed: {error}')
+        metrics.registry.inc('replays_copied', len(jobs) - len(failures))
+        self.copied += len(jobs) - len(failures)
+        self.failed += len(failures)
+
+    async def discard(self, new_ids: List[int]):
+        """Remove replays copied for rows that were not written after all."""
+        await self._run(self._discard, new_ids)
+
+    def summary(self) -> str:
+        missing = ', '.join(f'{table_name}: {count}' for table_name, count in self.missing.items())
+        text = f'{self.copied} replays are copied ({self.method}), {self.failed} failed, missing replays {missing}'
+        if self.missing_examples:
+            text += f' (e.g. {", ".join(self.missing_examples)})'
+        return text
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+copier: ReplayCopier = None
+
+
+def create_copier(method: str, workers: int, log: Optional[Callable[[str], None]] = None):
+    global copier
+    if copier is None:
+        copier = ReplayCopier(method, workers, log)
+        copier.load()
@@ -0,0 +1,86 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, NamedTuple
+
+import checkpoint
+import snapshot
+import stored
+from stored import db_context
+
+
+class Shard(NamedTuple):
+    """Source scores with start_id < id <= end_id of one table."""
+    table_name: str
+    start_id: int
+    end_id: int
+
+    @property
+    def key(self) -> str:
+        return f'{self.table_name}:{self.start_id}-{self.end_id}'
+
+    @classmethod
+    def from_key(cls, key: str) -> 'Shard':
+        table_name, bounds = key.split(':')
+        start_id, end_id = bounds.split('-')
+        return cls(table_name, int(start_id), int(end_id))
+
+
+async def plan_shards(table_name: str, shard_count: int, after_id: int = 0) -> Dict[Shard, int]:
+    """Split the table's ids above after_id into ranges, returning each shard with the last id already migrated.
+
+    The plan is stored as scores checkpoints, so a resumed run picks up the same ranges."""
+    planned = await checkpoint.load_all('scores', table_name + ':')
+    if planned:
+        return {Shard.from_key(key): last_id for key, last_id in planned.items()}
+
+    if snapshot.current is not None:
+        min_id, max_id = snapshot.current.id_bounds(table_name, after_id)
+    else:
+        async with db_context(stored.source_pool) as (_, cur):
+            await cur.execute(f'select min(id) as min_id, max(id) as max_id from {table_name} where id > %s',
+                              [after_id])
+            row = await cur.fetchone()
+        min_id, max_id = row['min_id'], row['max_id']
+    if min_id is None:
+        return {}
+    start, end = min_id - 1, max_id
+    width = -(-(end - start) // shard_count)
+    shards = {Shard(table_name, shard_start, min(shard_start + width, end)): shard_start
+              for shard_start in range(start, end, width)}
+    await checkpoint.commit_many('scores', {shard.key: last_id for shard, last_id in shards.items()})
+    return shards
+
+
+class Progress:
+    """Handled score counts per shard and overall."""
+
+    def __init__(self, shards: List[Shard]):
+        self.handled = {shard: 0 for shard in shards}
+        self.finished = 0
+
+    @property
+    def total(self) -> int:
+        return sum(self.handled.values())
+
+    def add(self, shard: Shard, count: int) -> str:
+        self.handled[shard] = self.handled.get(shard, 0) + count  # a --worker learns its shards as it claims them
+        return f'{shard.key}: {self.handled[shard]} scores are handled, {self.total} in all shards'
+
+    def finish(self, shard: Shard) -> str:
+        self.finished += 1
+        return f'{shard.key} is finished ({self.finished} / {len(self.handled)} shards)'
+
+
+def concurrency_limit(requested: int) -> int:
+    """Shard workers hold one source and one target connection each, so stay within both pools."""
+    pools = [pool for pool in (stored.source_pool, stored.target_pool) if pool is not None]
+    return max(1, min(requested, *[pool.maxsize for pool in pools]))
+
+
+async def run_shards(shards: List[Shard], worker: Callable[[Shard], Awaitable[None]], concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(shard: Shard):
+        async with semaphore:
+            await worker(shard)
+
+    await asyncio.gather(*[run(shard) for shard in shards])
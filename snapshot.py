@@ -0,0 +1,281 @@
+"""Columnar snapshot of the source score tables and `maps`, one NumPy .npy file per column.
+
+`python main.py --export-snapshot DIR` writes it; `python main.py --snapshot DIR` then migrates from it without
+touching the source database. Columns are opened as read-only memmaps, so a batch or an aggregate only pages in
+what it reads. Each score table also gets a writable `migrated_pp` column, filled with the pp every row was
+written with, which the stats and rank phases aggregate from instead of rescanning the target `scores`.
+
+Those columns only hold what this run migrated, so they stand for the target `scores` only if it had no rows when
+the run started: otherwise (`covers_target` is False) the stats and rank phases scan the target as usual."""
+import json
+import os
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import source
+import stored
+from gamemodes import bancho_modes
+from records import SCORE_COLUMNS, Score
+from stored import db_context
+
+try:
+    import numpy as np
+except ImportError:  # snapshots need numpy, the live migration does not
+    np = None
+
+SCORE_TABLES = ('scores_vn', 'scores_rx', 'scores_ap')
+
+SCORE_DTYPES = {
+    'id': 'i8', 'map_md5': 'S32', 'score': 'i8', 'pp': 'f8', 'acc': 'f8', 'max_combo': 'i4', 'mods': 'i8',
+    'n300': 'i4', 'n100': 'i4', 'n50': 'i4', 'nmiss': 'i4', 'ngeki': 'i4', 'nkatu': 'i4', 'grade': 'S2',
+    'status': 'i1', 'mode': 'i1', 'play_time': 'i8', 'time_elapsed': 'i8', 'client_flags': 'i8', 'userid': 'i8',
+    'perfect': 'i1', 'online_checksum': 'S32',
+}
+MAP_DTYPES = {'id': 'i8', 'md5': 'S32'}
+MANIFEST = 'manifest.json'
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError('snapshots need numpy, pip install numpy')
+
+
+def _dtype(column: str, dtypes: Dict[str, str], value) -> str:
+    if isinstance(value, datetime):
+        return 'M8[s]'
+    return dtypes.get(column, 'f8' if isinstance(value, float) else 'i8' if isinstance(value, int) else 'S64')
+
+
+def _to_python(column: np.ndarray) -> list:
+    if column.dtype.kind == 'M':
+        return column.astype(object).tolist()  # datetime.datetime
+    if column.dtype.kind == 'S':
+        return [value.decode() for value in column.tolist()]
+    return column.tolist()
+
+
+class ColumnWriter:
+    """Fills one .npy memmap per column from tuple rows in the order of names, sized for `rows` rows."""
+
+    def __init__(self, folder: str, rows: int, names: Sequence[str], dtypes: Dict[str, str]):
+        self.folder = folder
+        self.rows = rows
+        self.names = names
+        self.dtypes = dtypes
+        self.written = 0
+        self._columns: Dict[str, np.ndarray] = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def append(self, rows: List[tuple]):
+        rows = rows[:self.rows - self.written]
+        if not rows:
+            return
+        if not self._columns:
+            for column, value in zip(self.names, rows[0]):
+                self._columns[column] = np.lib.format.open_memmap(
+                    os.path.join(self.folder, column + '.npy'), mode='w+',
+                    dtype=_dtype(column, self.dtypes, value), shape=(self.rows,))
+        end = self.written + len(rows)
+        for values, array in zip(zip(*rows), self._columns.values()):
+            if array.dtype.kind == 'S':
+                values = [value.encode() for value in values]
+            array[self.written:end] = values
+        self.written = end
+
+    def close(self) -> Dict[str, str]:
+        """Flush the columns, returning their dtypes."""
+        if not self._columns:  # empty table
+            for column in self.names:
+                dtype = self.dtypes[column]
+                self._columns[column] = np.lib.format.open_memmap(os.path.join(self.folder, column + '.npy'),
+                                                                  mode='w+', dtype=dtype, shape=(self.rows,))
+        for array in self._columns.values():
+            array.flush()
+        return {column: array.dtype.str for column, array in self._columns.items()}
+
+
+async def export(folder: str, batch_size: int):
+    """Snapshot every score table and `maps` from the source database into folder."""
+    _require_numpy()
+    os.makedirs(folder, exist_ok=True)
+    manifest = {'created': datetime.now().isoformat(timespec='seconds'), 'tables': {}}
+
+    async with db_context(stored.source_pool) as (_, cur):
+        await cur.execute('select count(*) as total from maps')
+        total = (await cur.fetchone())['total']
+        maps = ColumnWriter(os.path.join(folder, 'maps'), total, list(MAP_DTYPES), MAP_DTYPES)
+        await cur.execute('select id, md5 from maps order by id')
+        while rows := await cur.fetchmany(batch_size):
+            maps.append([(row['id'], row['md5']) for row in rows])
+    manifest['tables']['maps'] = {'rows': maps.written, 'columns': maps.close()}
+
+    for table_name in SCORE_TABLES:
+        async with db_context(stored.source_pool) as (_, cur):
+            await cur.execute(f'select coalesce(max(id), 0) as max_id from {table_name}')
+            max_id = (await cur.fetchone())['max_id']
+        # rows added while exporting are left to a later --delta run
+        total = await source.count_scores(table_name, 0, max_id)
+        scores = ColumnWriter(os.path.join(folder, table_name), total, SCORE_COLUMNS, SCORE_DTYPES)
+        async for rows in source.stream_scores(table_name, batch_size, 0, max_id):
+            scores.append(rows)
+        columns = scores.close()
+        migrated_pp = np.lib.format.open_memmap(os.path.join(folder, table_name, 'migrated_pp.npy'), mode='w+',
+                                                dtype='f8', shape=(scores.written,))
+        migrated_pp[:] = np.nan  # not migrated yet
+        migrated_pp.flush()
+        manifest['tables'][table_name] = {'rows': scores.written, 'max_id': max_id, 'columns': columns}
+
+    with open(os.path.join(folder, MANIFEST + '.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(os.path.join(folder, MANIFEST + '.tmp'), os.path.join(folder, MANIFEST))
+
+
+class Snapshot:
+    """Read access to an exported snapshot; source ids are sorted, so id ranges are binary searches."""
+
+    def __init__(self, folder: str):
+        _require_numpy()
+        self.folder = folder
+        with open(os.path.join(folder, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self._columns: Dict[Tuple[str, str], np.ndarray] = {}
+        self.covers_target = False  # whether the migrated rows are all of the target scores, see main.prepare
+
+    def rows(self, table_name: str) -> int:
+        return self.manifest['tables'][table_name]['rows']
+
+    def column(self, table_name: str, column: str) -> np.ndarray:
+        key = (table_name, column)
+        array = self._columns.get(key)
+        if array is None:
+            mode = 'r+' if column == 'migrated_pp' else 'r'
+            array = np.load(os.path.join(self.folder, table_name, column + '.npy'), mmap_mode=mode)
+            # rows deleted while exporting leave an unwritten tail
+            array = self._columns[key] = array[:self.rows(table_name)]
+        return array
+
+    def _range(self, table_name: str, start_id: int, end_id: Optional[int]) -> Tuple[int, int]:
+        """Row positions of start_id < id <= end_id."""
+        ids = self.column(table_name, 'id')
+        lo = int(np.searchsorted(ids, start_id, side='right'))
+        hi = len(ids) if end_id is None else int(np.searchsorted(ids, end_id, side='right'))
+        return lo, max(lo, hi)
+
+    def count_scores(self, table_name: str, start_id: int = 0, end_id: Optional[int] = None) -> int:
+        lo, hi = self._range(table_name, start_id, end_id)
+        return hi - lo
+
+    def id_bounds(self, table_name: str, after_id: int = 0) -> Tuple[Optional[int], Optional[int]]:
+        lo, hi = self._range(table_name, after_id, None)
+        if lo == hi:
+            return None, None
+        ids = self.column(table_name, 'id')
+        return int(ids[lo]), int(ids[hi - 1])
+
+    async def stream_scores(self, table_name: str, batch_size: int, start_id: int = 0,
+                            end_id: Optional[int] = None) -> AsyncIterator[List[Score]]:
+        """Same pages as source.stream_scores, built from column slices."""
+        lo, hi = self._range(table_name, start_id, end_id)
+        for start in range(lo, hi, batch_size):
+            end = min(start + batch_size, hi)
+            columns = [_to_python(self.column(table_name, name)[start:end]) for name in SCORE_COLUMNS]
+            yield [tuple.__new__(Score, values) for values in zip(*columns)]
+
+    def maps(self) -> Iterator[Tuple[str, int]]:
+        """(md5, id) of every snapshotted map."""
+        return zip(*[_to_python(self.column('maps', name)) for name in ('md5', 'id')])
+
+    def reset_migrated(self):
+        """Forget the pp a previous run recorded, for a run that starts over."""
+        for table_name in SCORE_TABLES:
+            migrated_pp = self.column(table_name, 'migrated_pp')
+            migrated_pp[:] = np.nan
+            migrated_pp.flush()
+
+    def record_pp(self, table_name: str, source_ids: Sequence[int], pps: Sequence[float]):
+        """Remember the pp these source rows were written to the target with."""
+        ids = self.column(table_name, 'id')
+        self.column(table_name, 'migrated_pp')[np.searchsorted(ids, source_ids)] = pps
+
+    def flush(self):
+        """Write the recorded pp of the migrated_pp columns back to their files."""
+        for (_, column), array in self._columns.items():
+            if column == 'migrated_pp':
+                array.flush()
+
+    def _migrated(self, table_name: str, modes: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Row positions of the migrated rows with a target mode in modes, and their target modes."""
+        # as main.insert_scores writes them
+        target_modes = bancho_modes(self.column(table_name, 'mode'), self.column(table_name, 'mods'))
+        rows = np.flatnonzero(~np.isnan(self.column(table_name, 'migrated_pp')) & np.isin(target_modes, modes))
+        return rows, target_modes[rows]
+
+    def stats_rows(self, modes: Sequence[int], maps: Iterable[Tuple[str, int]]
+                   ) -> List[Tuple[int, int, int, int, int]]:
+        """(userid, mode, total_hits, plays, playtime) of every migrated (user, mode), as the stats phase's scan.
+
+        maps are the (md5, total_length) of the target `maps` that scan joins."""
+        maps = list(maps)
+        map_md5 = np.array([md5.encode() for md5, _ in maps], dtype='S32')
+        order = np.argsort(map_md5)
+        # a sentinel above every md5 keeps searchsorted positions in bounds
+        sorted_md5 = np.append(map_md5[order], np.array([b'\xff' * 32], dtype='S32'))
+        total_lengths = np.append(np.array([length for _, length in maps], dtype=np.int64)[order], 0)
+
+        keys, hits, lengths = [], [], []
+        for table_name in SCORE_TABLES:
+            rows, target_modes = self._migrated(table_name, modes)
+            keys.append(self.column(table_name, 'userid')[rows] * 16 + target_modes)
+            hits.append(sum(self.column(table_name, column)[rows].astype(np.int64)
+                            for column in ('n300', 'n100', 'n50', 'ngeki', 'nkatu')))
+            md5 = self.column(table_name, 'map_md5')[rows]
+            position = np.searchsorted(sorted_md5, md5)
+            known = sorted_md5[position] == md5  # left join maps
+            passed = self.column(table_name, 'grade')[rows] != b'F'
+            lengths.append(np.where(known & passed, total_lengths[position], 0))
+        keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        total_hits = np.bincount(inverse, weights=np.concatenate(hits), minlength=len(keys))
+        plays = np.bincount(inverse, minlength=len(keys))
+        playtime = np.bincount(inverse, weights=np.concatenate(lengths), minlength=len(keys))
+        return [(int(key) // 16, int(key) % 16, int(hit), int(play), int(length))
+                for key, hit, play, length in zip(keys.tolist(), total_hits, plays, playtime)]
+
+    def rank_groups(self, modes: Sequence[int], ranked_md5: Iterable[str],
+                    after_user_id: int = 0) -> Iterator[Tuple[int, int, List[Tuple[float, float]], int]]:
+        """(userid, mode, (pp, acc) of the best 100, ranked score count) of every migrated (user, mode) with
+        ranked scores on ranked maps, ordered by userid & mode as the rank phase streams them.
+
+        ranked_md5 are the md5 of the ranked target `maps` that the rank phase joins."""
+        ranked_md5 = np.array([md5.encode() for md5 in ranked_md5], dtype='S32')
+        users, target_modes, pps, accs = [], [], [], []
+        for table_name in SCORE_TABLES:
+            rows, modes_of_rows = self._migrated(table_name, modes)
+            keep = ((self.column(table_name, 'status')[rows] == 2)
+                    & np.isin(self.column(table_name, 'map_md5')[rows], ranked_md5)
+                    & (self.column(table_name, 'userid')[rows] > after_user_id))
+            rows = rows[keep]
+            users.append(self.column(table_name, 'userid')[rows])
+            target_modes.append(modes_of_rows[keep])
+            pps.append(self.column(table_name, 'migrated_pp')[rows])
+            accs.append(self.column(table_name, 'acc')[rows])
+        users, target_modes = np.concatenate(users), np.concatenate(target_modes)
+        pps, accs = np.concatenate(pps), np.concatenate(accs)
+        # as the rank phase's scan reads them back from bancho.py's scores (pp float(7,3), acc float(6,3)),
+        # ties in pp broken by acc
+        pps, accs = np.round(pps, 3), np.round(accs, 3)
+        order = np.lexsort((-accs, -pps, target_modes, users))
+        users, target_modes, pps, accs = users[order], target_modes[order], pps[order], accs[order]
+        starts = np.flatnonzero(np.r_[True, (users[1:] != users[:-1]) | (target_modes[1:] != target_modes[:-1])])
+        ends = np.r_[starts[1:], len(users)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            top = min(end, start + 100)
+            yield (int(users[start]), int(target_modes[start]),
+                   list(zip(pps[start:top].tolist(), accs[start:top].tolist())), end - start)
+
+
+current: Optional[Snapshot] = None
+
+
+def open_snapshot(folder: Optional[str]):
+    global current
+    current = Snapshot(folder) if folder else None
@@ -0,0 +1,71 @@
+import asyncio
+from typing import AsyncIterator, Callable, List, Optional
+
+from aiomysql import Cursor
+
+import limiter
+import metrics
+import snapshot
+import stored
+from records import SELECT_SCORE, Score, score_decoder
+from stored import db_context
+
+
+async def stream_scores(table_name: str, batch_size: int, start_id: int = 0,
+                        end_id: Optional[int] = None) -> AsyncIterator[List[Score]]:
+    """Yield scores with start_id < id <= end_id in id order, one page per query (keyset pagination).
+
+    Only one page is held in memory at a time, however large the table is. Reads the snapshot if one is open."""
+    if snapshot.current is not None:
+        async for rows in snapshot.current.stream_scores(table_name, batch_size, start_id, end_id):
+            metrics.registry.inc('source_rows', len(rows))
+            yield rows
+        return
+    last_id = start_id
+    decode = None
+    while True:
+        async with limiter.source_reads.slot():
+            with metrics.registry.timer('source_fetch'):
+                async with db_context(stored.source_pool, Cursor) as (_, cur):
+                    if end_id is None:
+                        await cur.execute(f'select {SELECT_SCORE} from {table_name} where id > %s '
+                                          'order by id limit %s', [last_id, batch_size])
+                    else:
+                        await cur.execute(f'select {SELECT_SCORE} from {table_name} where id > %s and id <= %s '
+                                          'order by id limit %s', [last_id, end_id, batch_size])
+                    # plain tuples decoded once into Score records, no dict per row
+                    decode = decode or score_decoder(cur.description)
+                    rows = decode(await cur.fetchall())
+        metrics.registry.inc('source_rows', len(rows))
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1].id
+
+
+async def count_scores(table_name: str, start_id: int = 0, end_id: Optional[int] = None) -> int:
+    if snapshot.current is not None:
+        return snapshot.current.count_scores(table_name, start_id, end_id)
+    async with db_context(stored.source_pool) as (_, cur):
+        if end_id is None:
+            await cur.execute(f'select count(*) as total from {table_name} where id > %s', [start_id])
+        else:
+            await cur.execute(f'select count(*) as total from {table_name} where id > %s and id <= %s',
+                              [start_id, end_id])
+        return (await cur.fetchone())['total']
+
+
+async def read_scores(queue: asyncio.Queue, table_name: str, batch_size: int, start_id: int = 0,
+                      end_id: Optional[int] = None, on_page: Optional[Callable[[List[Score]], None]] = None):
+    """Feed pages into a bounded queue, waiting while it is full; None marks the end.
+
+    on_page sees every page as soon as it is read, before it waits in the queue."""
+    try:
+        async for rows in stream_scores(table_name, batch_size, start_id, end_id):
+            if on_page is not None:
+                on_page(rows)
+            await queue.put(rows)
+    finally:
+        await queue.put(None)
@@ -9,23 +9,32 @@ target_pool: Pool = None
 
 
 @asynccontextmanager
-async def db_context(thePool: Pool) -> (Connection, DictCursor):
+async def db_context(thePool: Pool, cursor_class=DictCursor) -> (Connection, DictCursor):
     try:
         conn: Connection = await thePool.acquire()
-        cur: DictCursor = await conn.cursor(DictCursor)
+        cur: DictCursor = await conn.cursor(cursor_class)
         yield conn, cur
     finally:
         await cur.close()
         await thePool.release(conn)
 
 
-async def create_pool():
+async def create_pool(source: bool = True, local_infile: bool = False):
+    """Connect to both databases, or only the target one when the source is read from a snapshot.
+
+    local_infile allows the LOAD DATA LOCAL bulk loads of writer.load_data on the target connections."""
     global source_pool, target_pool
-    if source_pool is not None and target_pool is not None:
-        return
-    source_pool = await aiomysql.create_pool(host=config.source_mysql_host, port=3306,
-                                             user=config.source_mysql_user, password=config.source_mysql_password,
-                                             db=config.source_mysql_dbname, charset='utf8')
-    target_pool = await aiomysql.create_pool(host=config.target_mysql_host, port=3306,
-                                             user=config.target_mysql_user, password=config.target_mysql_password,
-                                             db=config.target_mysql_dbname, charset='utf8', autocommit=True)
+    if source and source_pool is None:
+        source_pool = await aiomysql.create_pool(host=config.source_mysql_host, port=config.source_mysql_port,
+                                                 user=config.source_mysql_user,
+                                                 password=config.source_mysql_password,
+                                                 db=config.source_mysql_dbname, charset='utf8',
+                                                 maxsize=config.source_pool_size,
+                                                 connect_timeout=config.mysql_connect_timeout)
+    if target_pool is None:
+        target_pool = await aiomysql.create_pool(host=config.target_mysql_host, port=config.target_mysql_port,
+                                                 user=config.target_mysql_user,
+                                                 password=config.target_mysql_password,
+                                                 db=config.target_mysql_dbname, charset='utf8', autocommit=True,
+                                                 local_infile=local_infile, maxsize=config.target_pool_size,
+                                                 connect_timeout=config.mysql_connect_timeout)
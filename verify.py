@@ -0,0 +1,211 @@
+"""Source / target consistency check for `python main.py --verify REPORT`.
+
+The writer gives migrated scores new ids, so source and target rows are lined up by user instead: each chunk is a
+range of user ids, and both databases return the chunk's row count and the sum of a crc32 over the columns
+`main.score_row` copies, with the rx / ap offset of the mods added to the mode on the source side. The replays the
+copier should have brought over are counted per chunk on both sides. Only chunks where any of these differ are read
+row by row, pairing rows by hash to find the missing, unexpected and changed ones."""
+import asyncio
+import json
+import os
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import config
+import limiter
+import metrics
+import replays
+import stored
+from records import SCORE_COLUMNS
+from gamemodes import mode_offsets
+from mods import Mods
+from snapshot import SCORE_TABLES
+from stored import db_context
+
+# pp is recalculated and mode offset, everything else is copied as it is
+COLUMNS = [name for name in SCORE_COLUMNS if name not in ('id', 'pp')]
+# a changed row still has these, a missing or unexpected one has no counterpart with them
+IDENTITY = ('userid', 'map_md5', 'online_checksum')
+KINDS = ('missing', 'unexpected', 'changed', 'missing_replays')
+
+Chunk = Tuple[int, int]  # userid > start and userid <= end
+
+
+# the target mode of a source row, gamemodes.mode_offsets in SQL
+SOURCE_MODE = f'mode + case when mods & {int(Mods.AUTOPILOT)} then 8 when mods & {int(Mods.RELAX)} then 4 else 0 end'
+
+
+def row_hash(mode: str = 'mode') -> str:
+    fields = ['round(acc, 3)' if name == 'acc' else mode if name == 'mode' else name for name in COLUMNS]
+    return f"crc32(concat_ws('|', {', '.join(fields)}))"
+
+
+def comparable(row: dict, source: bool = False) -> Dict[str, object]:
+    values = {name: row[name] for name in COLUMNS}
+    values['acc'] = round(values['acc'], 3)
+    if source:
+        (offset,) = mode_offsets([values['mods']])
+        values['mode'] += int(offset)
+    return values
+
+
+class Report:
+    """Differences by kind: all of them counted, the first `limit` of each kind listed."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.counts = {kind: 0 for kind in KINDS}
+        self.examples: Dict[str, List[dict]] = {kind: [] for kind in KINDS}
+        self.chunks: List[dict] = []
+        self.checked = 0
+        self.source_rows = 0
+        self.target_rows = 0
+
+    def add(self, kind: str, example: dict):
+        self.counts[kind] += 1
+        if len(self.examples[kind]) < self.limit:
+            self.examples[kind].append(example)
+
+    @property
+    def consistent(self) -> bool:
+        return not self.chunks
+
+    def as_dict(self) -> dict:
+        return {
+            'consistent': self.consistent,
+            'chunks_checked': self.checked,
+            'source_rows': self.source_rows,
+            'target_rows': self.target_rows,
+            'counts': self.counts,
+            'differing_chunks': sorted(self.chunks, key=lambda chunk: chunk['start_userid']),
+            **self.examples,
+        }
+
+    def write(self, path: str):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, default=str)
+        os.replace(path + '.tmp', path)
+
+
+class Verifier:
+    def __init__(self, report: Report):
+        self.report = report
+        # replays handle_osr had to copy, and the ones that arrived
+        self.source_replays = {table_name: replays.list_replays(config.replay_folder + folder)
+                               for table_name, folder in replays.REPLAY_FOLDERS.items()}
+        self.target_replays = replays.list_replays(config.new_bancho_folder + ".data/osr/")
+
+    async def _source(self, sql: str, args: list) -> List[dict]:
+        async with limiter.source_reads.slot(), db_context(stored.source_pool) as (_, cur):
+            await cur.execute(sql, args)
+            return await cur.fetchall()
+
+    async def _target(self, sql: str, args: list) -> List[dict]:
+        async with db_context(stored.target_pool) as (_, cur):
+            await cur.execute(sql, args)
+            return await cur.fetchall()
+
+    async def plan(self, chunk_users: int) -> List[Chunk]:
+        bounds = [await self._source(f'select min(userid) as low, max(userid) as high from {table_name}', [])
+                  for table_name in SCORE_TABLES]
+        bounds.append(await self._target('select min(userid) as low, max(userid) as high from scores', []))
+        lows = [rows[0]['low'] for rows in bounds if rows[0]['low'] is not None]
+        if not lows:
+            return []
+        start, end = min(lows) - 1, max(rows[0]['high'] for rows in bounds if rows[0]['high'] is not None)
+        return [(low, min(low + chunk_users, end)) for low in range(start, end, chunk_users)]
+
+    async def check(self, chunk: Chunk):
+        """Compare the chunk's aggregates and replay counts, reading its rows only if they differ."""
+        where = 'where userid > %s and userid <= %s'
+        source, target, source_ids, target_ids = await asyncio.gather(
+            asyncio.gather(*[self._source(f'select count(*) as row_count, '
+                                          f'coalesce(sum({row_hash(SOURCE_MODE)}), 0) '
+                                          f'as row_hash from {table_name} {where}', list(chunk))
+                             for table_name in SCORE_TABLES]),
+            self._target(f'select count(*) as row_count, coalesce(sum({row_hash()}), 0) as row_hash '
+                         f'from scores {where}', list(chunk)),
+            asyncio.gather(*[self._source(f"select id from {table_name} {where} and grade != 'F'", list(chunk))
+                             for table_name in SCORE_TABLES]),
+            self._target(f"select id from scores {where} and grade != 'F'", list(chunk)))
+        summary = {
+            'start_userid': chunk[0],
+            'end_userid': chunk[1],
+            'source_rows': sum(int(rows[0]['row_count']) for rows in source),
+            'target_rows': int(target[0]['row_count']),
+            'source_hash': sum(int(rows[0]['row_hash']) for rows in source),
+            'target_hash': int(target[0]['row_hash']),
+            'expected_replays': sum(len(self.source_replays[table_name].intersection(row['id'] for row in rows))
+                                    for table_name, rows in zip(SCORE_TABLES, source_ids)),
+            'target_replays': len(self.target_replays.intersection(row['id'] for row in target_ids)),
+        }
+        self.report.checked += 1
+        self.report.source_rows += summary['source_rows']
+        self.report.target_rows += summary['target_rows']
+        metrics.registry.inc('chunks')
+        if (summary['source_rows'], summary['source_hash'], summary['expected_replays']) == \
+                (summary['target_rows'], summary['target_hash'], summary['target_replays']):
+            return
+        self.report.chunks.append(summary)
+        metrics.registry.inc('differing_chunks')
+        await self.drill_down(chunk)
+
+    async def drill_down(self, chunk: Chunk):
+        where = 'where userid > %s and userid <= %s'
+        columns = ', '.join(COLUMNS)
+        by_hash: Dict[int, List[Tuple[str, dict]]] = defaultdict(list)
+        for table_name in SCORE_TABLES:
+            for row in await self._source(f'select id, {row_hash(SOURCE_MODE)} as row_hash, '
+                                          f'{columns} from {table_name} {where} order by id', list(chunk)):
+                by_hash[row['row_hash']].append((table_name, row))
+        unexpected = []
+        for row in await self._target(f'select id, {row_hash()} as row_hash, {columns} from scores {where} '
+                                      'order by id', list(chunk)):
+            if by_hash.get(row['row_hash']):
+                table_name, source_row = by_hash[row['row_hash']].pop(0)
+                self.check_replay(table_name, source_row, row['id'])
+            else:
+                unexpected.append(row)
+
+        missing: Dict[tuple, List[Tuple[str, dict]]] = defaultdict(list)
+        for rows in by_hash.values():
+            for table_name, row in rows:
+                missing[tuple(row[name] for name in IDENTITY)].append((table_name, row))
+        for row in unexpected:
+            candidates = missing.get(tuple(row[name] for name in IDENTITY))
+            if not candidates:
+                self.report.add('unexpected', {'target_id': row['id'], **{name: row[name] for name in IDENTITY}})
+                continue
+            table_name, source_row = candidates.pop(0)
+            source_values = comparable(source_row, source=True)
+            target_values = comparable(row)
+            self.report.add('changed', {
+                'table': table_name, 'source_id': source_row['id'], 'target_id': row['id'],
+                'columns': {name: [source_values[name], target_values[name]] for name in COLUMNS
+                            if source_values[name] != target_values[name]},
+            })
+            self.check_replay(table_name, source_row, row['id'])
+        for rows in missing.values():
+            for table_name, row in rows:
+                self.report.add('missing', {'table': table_name, 'source_id': row['id'],
+                                            **{name: row[name] for name in IDENTITY}})
+
+    def check_replay(self, table_name: str, source_row: dict, target_id: int):
+        if source_row['grade'] != 'F' and source_row['id'] in self.source_replays[table_name] \
+                and target_id not in self.target_replays:
+            self.report.add('missing_replays', {'table': table_name, 'source_id': source_row['id'],
+                                                'target_id': target_id})
+
+
+async def run(chunks: List[Chunk], verifier: Verifier, concurrency: int,
+              log: Optional[Callable[[str], None]] = None):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(chunk: Chunk):
+        async with semaphore:
+            await verifier.check(chunk)
+        if log is not None and verifier.report.checked % 100 == 0:
+            log(f'{verifier.report.checked} / {len(chunks)} chunks are checked, '
+                f'{len(verifier.report.chunks)} differ')
+
+    await asyncio.gather(*[check(chunk) for chunk in chunks])
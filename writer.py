@@ -0,0 +1,160 @@
+import asyncio
+import tempfile
+from datetime import datetime
+from typing import Iterable, List, Optional, Sequence
+
+from aiomysql import DataError, DictCursor, IntegrityError
+
+import checkpoint
+import coordinator
+import limiter
+import metrics
+import stored
+from records import SCORE_COLUMNS
+from stored import db_context
+
+INSERT_SCORE = ("INSERT INTO scores "
+                "VALUES (%s, "
+                "%s, %s, %s, %s, "
+                "%s, %s, %s, %s, "
+                "%s, %s, %s, %s, "
+                "%s, %s, %s, %s, "
+                "%s, %s, %s, %s, "
+                "%s)")
+
+
+def _tsv_field(value) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+async def load_data(cur: DictCursor, table_name: str, columns: Sequence[str], rows: Iterable[Sequence]) -> int:
+    """Bulk load rows with LOAD DATA LOCAL INFILE from a temporary tab separated file, returning the rows loaded."""
+    with tempfile.NamedTemporaryFile('w', suffix='.tsv', encoding='utf-8') as f:
+        for row in rows:
+            f.write('\t'.join(map(_tsv_field, row)) + '\n')
+        f.flush()
+        await cur.execute(f"LOAD DATA LOCAL INFILE %s INTO TABLE {table_name} CHARACTER SET utf8mb4 "
+                          f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({', '.join(columns)})",
+                          [f.name])
+    return cur.rowcount
+
+
+class ScoreWriter:
+    """Writes target score rows as multi-row INSERTs, or LOAD DATA with method 'load_data',
+    `transaction_size` rows per transaction.
+
+    Ids are assigned here rather than by auto_increment, so every row's id is known before it is written.
+    A --worker process passes id_block: it reserves ids from the coordinator that many at a time, and fences every
+    transaction that moves a scores checkpoint with the lease on that unit."""
+
+    def __init__(self, transaction_size: int, method: str = 'insert', id_block: int = 0):
+        if method not in ('insert', 'load_data'):
+            raise ValueError(f'unknown score insert method {method!r}')
+        self.transaction_size = transaction_size
+        self.method = method
+        self.id_block = id_block
+        self._next_id: Optional[int] = None
+        self._block_end = 0
+        self._reserving = asyncio.Lock()
+
+    async def prepare(self):
+        if self.id_block:
+            return
+        async with db_context(stored.target_pool) as (_, cur):
+            await cur.execute('select coalesce(max(id), 0) as max_id from scores')
+            self._next_id = (await cur.fetchone())['max_id'] + 1
+
+    @property
+    def max_id(self) -> int:
+        return self._next_id - 1
+
+    async def allocate(self, count: int) -> range:
+        if self.id_block and (self._next_id is None or self._next_id + count > self._block_end):
+            async with self._reserving:
+                if self._next_id is None or self._next_id + count > self._block_end:  # unless reserved meanwhile
+                    block = await coordinator.reserve_ids(max(count, self.id_block))
+                    self._next_id, self._block_end = block.start, block.stop
+        ids = range(self._next_id, self._next_id + count)
+        self._next_id += count
+        return ids
+
+    async def write(self, rows: List[list], ids: Optional[List[int]] = None, checkpoint_key: Optional[str] = None,
+                    source_ids: Optional[List[int]] = None) -> List[Optional[int]]:
+        """Insert rows (without id column), returning each row's new id, or None if a data error kept it out.
+        Any other error is raised, leaving the rows to --resume.
+
+        With checkpoint_key, that scores checkpoint advances to the chunk's last source id in the same transaction."""
+        ids = list(await self.allocate(len(rows)) if ids is None else ids)
+        for start in range(0, len(rows), self.transaction_size):
+            end = start + self.transaction_size
+            chunk = [[score_id] + row for score_id, row in zip(ids[start:end], rows[start:end])]
+            chunk_source_ids = source_ids[start:end] if checkpoint_key is not None else [None] * len(chunk)
+            last_id = None if checkpoint_key is None else max(chunk_source_ids)
+            if not await self._write_chunk(chunk, checkpoint_key, last_id):
+                for offset, (row, source_id) in enumerate(zip(chunk, chunk_source_ids)):
+                    if not await self._write_chunk([row], checkpoint_key, source_id):
+                        ids[start + offset] = None
+                if checkpoint_key is not None:
+                    await self._commit_checkpoint(checkpoint_key, last_id)  # skipped rows count as handled
+        return ids
+
+    async def _commit_checkpoint(self, checkpoint_key: str, last_id: int):
+        if not self.id_block:
+            await checkpoint.commit('scores', checkpoint_key, last_id)
+            return
+        async with db_context(stored.target_pool) as (conn, cur):
+            await conn.begin()
+            try:
+                await coordinator.fence(cur, checkpoint_key)
+                await checkpoint.save(cur, 'scores', checkpoint_key, last_id)
+                await conn.commit()
+            except:
+                await conn.rollback()
+                raise
+
+    async def _write_chunk(self, chunk: List[list], checkpoint_key: Optional[str], last_id: Optional[int]) -> bool:
+        async with limiter.target_writes.slot() as slot, db_context(stored.target_pool) as (conn, cur):
+            with metrics.registry.timer('target_insert'):
+                await conn.begin()
+                try:
+                    if self.id_block and checkpoint_key is not None:
+                        await coordinator.fence(cur, checkpoint_key)
+                    if self.method == 'load_data':
+                        # LOAD DATA LOCAL turns bad rows into warnings, a short count fails the chunk instead
+                        if await load_data(cur, 'scores', SCORE_COLUMNS, chunk) != len(chunk):
+                            raise DataError('rows skipped by LOAD DATA')
+                    else:
+                        await cur.executemany(INSERT_SCORE, chunk)
+                    if checkpoint_key is not None:
+                        await checkpoint.save(cur, 'scores', checkpoint_key, last_id)
+                    await conn.commit()
+                except (IntegrityError, DataError):
+                    # a bad row: write() retries the chunk row by row and skips the rows that fail again
+                    await conn.rollback()
+                    metrics.registry.inc('insert_failures')
+                    slot.failed = True
+                    return False
+                except:
+                    # connection, lock wait, lease & cancellation: the checkpoint stays before the chunk
+                    await conn.rollback()
+                    raise
+        metrics.registry.inc('rows_inserted', len(chunk))
+        return True
+
+
+writer: ScoreWriter = None
+
+
+async def create_writer(transaction_size: int, method: str = 'insert', id_block: int = 0):
+    global writer
+    if writer is None:
+        writer = ScoreWriter(transaction_size, method, id_block)
+    await writer.prepare()